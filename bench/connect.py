@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# t2jrbot - simple but elegant IRC bot
+# Copyright © 2014 Tuomas Räsänen <tuomasjjrasanen@tjjr.fi>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import t2jrbot.core
+import t2jrbot.log
+import t2jrbot.net
+
+# Resolves to a blackholed address first and to the loopback second.
+_BLACKHOLE_HOST = "blackhole.invalid"
+
+class _Server(object):
+    """Local server running `serve(conn)` for each accepted client."""
+
+    def __init__(self, serve, family=socket.AF_INET, address="127.0.0.1"):
+        self.__serve = serve
+        self.__sock = socket.socket(family, socket.SOCK_STREAM)
+        self.__sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.__sock.bind((address, 0))
+        self.__sock.listen(5)
+        self.port = self.__sock.getsockname()[1]
+        self.__threads = []
+        thread = threading.Thread(target=self.__accept)
+        thread.daemon = True
+        thread.start()
+
+    def join(self, timeout=1):
+        """Wait for clients served so far, `timeout` seconds each."""
+        for thread in list(self.__threads):
+            thread.join(timeout)
+
+    def __accept(self):
+        while True:
+            conn, _ = self.__sock.accept()
+            thread = threading.Thread(target=self.__serve_conn, args=(conn,))
+            thread.daemon = True
+            self.__threads.append(thread)
+            thread.start()
+
+    def __serve_conn(self, conn):
+        try:
+            self.__serve(conn)
+        except (socket.error, EnvironmentError):
+            pass
+        finally:
+            conn.close()
+
+def _drain(conn):
+    while conn.recv(4096):
+        pass
+
+def _serve_tls_burst(certfile, keyfile, lines):
+    import ssl
+    data = "".join([":irc.example.org PRIVMSG #t2jrbot :line %d %s\r\n"
+                    % (i, "x" * 100) for i in range(lines)])
+
+    def serve(conn):
+        conn = ssl.wrap_socket(conn, server_side=True,
+                               certfile=certfile, keyfile=keyfile)
+        conn.sendall(data)
+        _drain(conn)
+    return serve
+
+def _serve_tls_handshake(certfile, keyfile):
+    import ssl
+
+    def serve(conn):
+        try:
+            ssl.wrap_socket(conn, server_side=True,
+                            certfile=certfile, keyfile=keyfile)
+        except ssl.SSLError:
+            # The client is expected to reject the certificate.
+            pass
+    return serve
+
+def _unused_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def _has_ipv6_loopback():
+    if not socket.has_ipv6:
+        return False
+    try:
+        sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        sock.bind(("::1", 0))
+        sock.close()
+    except socket.error:
+        return False
+    return True
+
+def _install_blackhole_resolver(blackhole_address):
+    getaddrinfo = socket.getaddrinfo
+
+    def resolve(host, port, *args):
+        if host != _BLACKHOLE_HOST:
+            return getaddrinfo(host, port, *args)
+        return [(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, "",
+                 (blackhole_address, port)),
+                (socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, "",
+                 ("127.0.0.1", port))]
+    socket.getaddrinfo = resolve
+
+def _make_certificate(tmpdir):
+    certfile = os.path.join(tmpdir, "cert.pem")
+    keyfile = os.path.join(tmpdir, "key.pem")
+    with open(os.devnull, "w") as devnull:
+        try:
+            subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048",
+                                   "-nodes", "-days", "1", "-subj", "/CN=localhost",
+                                   "-keyout", keyfile, "-out", certfile],
+                                  stdout=devnull, stderr=devnull)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+    return certfile, keyfile
+
+class _Harness(object):
+    """Run connection scenarios one after another in the bot loop."""
+
+    def __init__(self, bot):
+        self.__bot = bot
+        self.__scenarios = []
+        self.failures = 0
+
+    def add(self, name, expect_error, host, port, **kwargs):
+        """Connect to `host` and `port`, expecting success or an error."""
+        self.__scenarios.append((name, expect_error, host, port, kwargs, None))
+
+    def add_burst(self, name, host, port, lines, **kwargs):
+        """Connect and receive `lines` IRC messages."""
+        self.__scenarios.append((name, False, host, port, kwargs, lines))
+
+    def start(self):
+        self.__bot.call_soon(self.__next)
+
+    def __next(self):
+        if not self.__scenarios:
+            self.__bot.stop()
+            return
+        name, expect_error, host, port, kwargs, lines = self.__scenarios.pop(0)
+        start = time.time()
+
+        def connected(sock, error):
+            elapsed = time.time() - start
+            if lines is None or error is not None:
+                if sock is not None:
+                    sock.close()
+                self.__report(name, elapsed, expect_error == (error is not None),
+                              error or "connected")
+                self.__next()
+                return
+            self.__receive(name, start, sock, lines)
+
+        t2jrbot.net.Connector(self.__bot, host, port, connected, **kwargs)
+
+    def __receive(self, name, start, sock, lines):
+        irc = t2jrbot.core.IRC(log=self.__bot.log)
+        irc.connect("127.0.0.1", 0, sock)
+        received = [0]
+
+        def readable():
+            try:
+                for _ in irc.recv():
+                    received[0] += 1
+            except t2jrbot.core.Error, e:
+                self.__finish_receive(name, start, irc, received[0], lines, e)
+                return
+            if received[0] >= lines:
+                self.__finish_receive(name, start, irc, received[0], lines, None)
+
+        self.__bot.add_reader(irc, readable)
+
+    def __finish_receive(self, name, start, irc, received, lines, error):
+        elapsed = time.time() - start
+        self.__bot.remove_reader(irc)
+        irc.shutdown()
+        irc.close()
+        self.__report(name, elapsed, error is None and received == lines,
+                      "%d/%d lines, %.0f msgs/s%s"
+                      % (received, lines, received / elapsed,
+                         "" if error is None else ", %s" % error))
+        self.__next()
+
+    def __report(self, name, elapsed, is_ok, outcome):
+        if not is_ok:
+            self.failures += 1
+        print("%-12s %8.1f ms  %-6s %s" % (name, elapsed * 1000,
+                                           "ok" if is_ok else "FAILED", outcome))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Exercise connecting on loopback")
+    parser.add_argument("--lines", type=int, default=20000,
+                        help="number of lines in the TLS burst")
+    parser.add_argument("--blackhole", default="192.0.2.1",
+                        help="address which drops connection attempts")
+    parser.add_argument("--attempt-delay", type=float, default=0.25,
+                        help="seconds between connection attempts")
+    return parser.parse_args()
+
+def main():
+    options = parse_args()
+
+    _install_blackhole_resolver(options.blackhole)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        certificate = _make_certificate(tmpdir)
+        if certificate is None:
+            print("openssl not found, skipping TLS", file=sys.stderr)
+        failures = run(options, certificate)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    if failures:
+        sys.exit(1)
+
+def run(options, certificate):
+    idle = _Server(_drain)
+    listener = _Server(lambda conn: None)
+    servers = [idle, listener]
+    timing = {"attempt_delay": options.attempt_delay}
+
+    with open(os.devnull, "w") as devnull:
+        # The default connection only keeps the loop running.
+        with t2jrbot.core.Bot("t2jrbot", {}, log=t2jrbot.log.Log(devnull),
+                              reconnect=False) as bot:
+            harness = _Harness(bot)
+            harness.add("ipv4", False, "127.0.0.1", listener.port, **timing)
+            if _has_ipv6_loopback():
+                listener6 = _Server(lambda conn: None, socket.AF_INET6, "::1")
+                servers.append(listener6)
+                harness.add("ipv6", False, "::1", listener6.port, **timing)
+            harness.add("blackhole", False, _BLACKHOLE_HOST, listener.port, **timing)
+            harness.add("refused", True, "127.0.0.1", _unused_port(), **timing)
+            harness.add("timeout", True, options.blackhole, listener.port,
+                        attempt_timeout=1, **timing)
+
+            if certificate is not None:
+                burst = _Server(_serve_tls_burst(certificate[0], certificate[1],
+                                                 options.lines))
+                handshake = _Server(_serve_tls_handshake(*certificate))
+                servers.extend([burst, handshake])
+                harness.add_burst("tls burst", "127.0.0.1", burst.port,
+                                  options.lines, tls=True, tls_verify=False,
+                                  **timing)
+                harness.add("bad cert", True, "localhost", handshake.port,
+                            tls=True, tls_verify=True, **timing)
+
+            harness.start()
+            bot.run("127.0.0.1", idle.port)
+
+    for server in servers:
+        server.join()
+    return harness.failures
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# t2jrbot - simple but elegant IRC bot
+# Copyright © 2014 Tuomas Räsänen <tuomasjjrasanen@tjjr.fi>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import time
+
+import t2jrbot.core
+import t2jrbot.log
+
+def _callback(prefix, command, params):
+    pass
+
+class _LegacyDispatcher(object):
+    # The set-merging dispatch Bot.run used before the dispatch cache.
+
+    def __init__(self):
+        self.__irc_callbacks_index_map = {}
+        self.__irc_callbacks = []
+
+    def add_irc_callback(self, callback, prefix=None, command=None):
+        i = len(self.__irc_callbacks)
+        self.__irc_callbacks.append(callback)
+        key = (prefix, command)
+        indices = self.__irc_callbacks_index_map.setdefault(key, [])
+        indices.append(i)
+
+    def dispatch_message(self, message):
+        prefix, command, params = message
+        callback_indices = set()
+
+        callback_indices.update(
+            self.__irc_callbacks_index_map.get((None, None), set()),
+            self.__irc_callbacks_index_map.get((prefix, None), set()),
+            self.__irc_callbacks_index_map.get((None, command), set()),
+            self.__irc_callbacks_index_map.get((prefix, command), set()))
+
+        for callback_index in sorted(callback_indices):
+            callback = self.__irc_callbacks[callback_index]
+            callback(prefix, command, params)
+
+_COMMANDS = ["PRIVMSG", "JOIN", "PART", "TOPIC", "PING", "001", "353"]
+
+def register(dispatcher, count):
+    for i in range(count):
+        dispatcher.add_irc_callback(_callback, command=_COMMANDS[i % len(_COMMANDS)])
+
+def measure(dispatcher, messages, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.time()
+        for message in messages:
+            dispatcher.dispatch_message(message)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / len(messages)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark IRC callback dispatch")
+    parser.add_argument("--messages", type=int, default=100000,
+                        help="number of dispatched messages per round")
+    parser.add_argument("--rounds", type=int, default=5,
+                        help="number of rounds, the best one is reported")
+    return parser.parse_args()
+
+def main():
+    options = parse_args()
+
+    # Messages are built beforehand, parsing is measured by parse.py.
+    messages = []
+    for i in range(options.messages):
+        prefix = "nick%d!user@example.org" % (i % 50)
+        command = _COMMANDS[i % len(_COMMANDS)]
+        messages.append(t2jrbot.core.Message(prefix, command,
+                                             ["#t2jrbot", "hello"]))
+
+    print("%10s %14s %14s" % ("callbacks", "legacy us/msg", "cached us/msg"))
+    with open(os.devnull, "w") as devnull:
+        for count in (1, 10, 100):
+            legacy = _LegacyDispatcher()
+            register(legacy, count)
+
+            # Keep the bot's log out of the results.
+            with t2jrbot.core.Bot("t2jrbot", {},
+                                  log=t2jrbot.log.Log(devnull)) as bot:
+                register(bot, count)
+
+                print("%10d %14.3f %14.3f"
+                      % (count,
+                         measure(legacy, messages, options.rounds) * 1e6,
+                         measure(bot, messages, options.rounds) * 1e6))
+
+if __name__ == "__main__":
+    main()
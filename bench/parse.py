@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# t2jrbot - simple but elegant IRC bot
+# Copyright © 2014 Tuomas Räsänen <tuomasjjrasanen@tjjr.fi>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import time
+
+import t2jrbot.core
+
+# Lines seen on real networks, including IRCv3 tags.
+_CORPUS = [
+    ":irc.example.org 001 t2jrbot :Welcome to the Example IRC Network t2jrbot!t2jrbot@192.0.2.1",
+    ":irc.example.org 005 t2jrbot CHANTYPES=# EXCEPTS INVEX CHANMODES=eIbq,k,flj,CFLMPQScgimnprstuz CHANLIMIT=#:120 PREFIX=(ov)@+ MAXLIST=bqeI:100 MODES=4 NETWORK=Example :are supported by this server",
+    ":irc.example.org 372 t2jrbot :- Welcome to irc.example.org, please read the rules.",
+    ":irc.example.org 353 t2jrbot = #t2jrbot :t2jrbot @fanatic +voiced alice bob carol dave eve mallory trent",
+    ":irc.example.org 366 t2jrbot #t2jrbot :End of /NAMES list.",
+    "PING :irc.example.org",
+    ":fanatic!~fan.atic@example.org PRIVMSG #t2jrbot :t2jrbot: !rcon_status",
+    ":alice!alice@2001:db8::1 PRIVMSG #t2jrbot :anyone up for a game tonight?",
+    ":bob!~bob@user/bob JOIN #t2jrbot",
+    ":carol!~carol@gateway/web/irccloud.com/x-abcdefgh PART #t2jrbot :Leaving",
+    ":dave!dave@203.0.113.7 QUIT :Ping timeout: 260 seconds",
+    ":eve!eve@example.net NICK :eve_",
+    ":fanatic!~fan.atic@example.org TOPIC #t2jrbot :Pizzas are here!",
+    ":ChanServ!ChanServ@services. MODE #t2jrbot +o fanatic",
+    "@time=2014-05-20T12:00:00.000Z;account=alice :alice!alice@2001:db8::1 PRIVMSG #t2jrbot :tagged hello",
+    "@msgid=abc\\:def\\sghi;+draft/reply=xyz :bob!~bob@user/bob PRIVMSG #t2jrbot :replying",
+]
+
+def parse_legacy(msg):
+    # The parser IRC.recv used before parse_message.
+    prefix = ""
+
+    if msg.startswith(":"):
+        prefix, sep, msg = msg.partition(" ")
+        prefix = prefix[1:]
+
+    command, _, paramstr = msg.partition(" ")
+
+    params = []
+    while paramstr:
+        if paramstr.startswith(":"):
+            param = paramstr[1:]
+            paramstr = ""
+        else:
+            param, _, paramstr = paramstr.partition(" ")
+        params.append(param)
+
+    return prefix, command, params
+
+def parse_legacy_nick(msg):
+    prefix, command, params = parse_legacy(msg)
+    nick, _, host = prefix.partition("!")
+    return nick
+
+def parse_nick(msg):
+    return t2jrbot.core.parse_message(msg).nick
+
+def measure(func, lines, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.time()
+        for line in lines:
+            func(line)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return len(lines) / best
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark IRC message parsing")
+    parser.add_argument("--lines", type=int, default=100000,
+                        help="number of parsed lines per round")
+    parser.add_argument("--rounds", type=int, default=5,
+                        help="number of rounds, the best one is reported")
+    return parser.parse_args()
+
+def main():
+    options = parse_args()
+
+    # Legacy parser does not understand tags.
+    untagged = [line for line in _CORPUS if not line.startswith("@")]
+    lines = [untagged[i % len(untagged)] for i in range(options.lines)]
+
+    print("%-22s %12.0f msgs/s" % ("legacy", measure(parse_legacy, lines, options.rounds)))
+    print("%-22s %12.0f msgs/s" % ("parse_message", measure(t2jrbot.core.parse_message, lines, options.rounds)))
+    print("%-22s %12.0f msgs/s" % ("legacy + nick", measure(parse_legacy_nick, lines, options.rounds)))
+    print("%-22s %12.0f msgs/s" % ("parse_message + nick", measure(parse_nick, lines, options.rounds)))
+
+    lines = [_CORPUS[i % len(_CORPUS)] for i in range(options.lines)]
+    print("%-22s %12.0f msgs/s" % ("parse_message, tagged", measure(t2jrbot.core.parse_message, lines, options.rounds)))
+
+if __name__ == "__main__":
+    main()
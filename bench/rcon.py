@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# t2jrbot - simple but elegant IRC bot
+# Copyright © 2014 Tuomas Räsänen <tuomasjjrasanen@tjjr.fi>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import distutils.spawn
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import t2jrbot.rcon
+
+_STATUS = ("map: q3dm17\n"
+           "num score ping name            lastmsg address               qport rate\n"
+           "--- ----- ---- --------------- ------- --------------------- ----- -----\n"
+           + "".join(["%3d     0   50 player%-9d       0 10.0.0.%d:27960     1234 25000\n"
+                      % (i, i, i) for i in range(16)]))
+
+# Runs a one-shot rcon query in a fresh interpreter, like crcon did in a
+# fresh process.
+_ONESHOT = ("import sys, t2jrbot.rcon; "
+            "c = t2jrbot.rcon.Client(sys.argv[1], int(sys.argv[2]), 'secret'); "
+            "sys.stdout.write(c.query('status'))")
+
+def serve(sock, packet_size):
+    # Stand-in for a game server, splits responses into multiple packets.
+    while True:
+        data, addr = sock.recvfrom(65535)
+        if not data.startswith(t2jrbot.rcon.OOB_HEADER + b"rcon "):
+            continue
+        for i in range(0, len(_STATUS), packet_size):
+            sock.sendto(t2jrbot.rcon.PRINT_HEADER + _STATUS[i:i + packet_size], addr)
+
+def measure(func, rounds):
+    elapsed = []
+    for _ in range(rounds):
+        start = time.time()
+        func()
+        elapsed.append(time.time() - start)
+    elapsed.sort()
+    return elapsed[len(elapsed) // 2]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark rcon query latency")
+    parser.add_argument("--rounds", type=int, default=20,
+                        help="number of queries, the median is reported")
+    parser.add_argument("--packet-size", type=int, default=256,
+                        help="payload bytes per response packet")
+    parser.add_argument("--packet-timeout", type=float, default=0.05,
+                        help="quiet period ending a response")
+    return parser.parse_args()
+
+def main():
+    options = parse_args()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    _, port = sock.getsockname()
+    server = threading.Thread(target=serve, args=(sock, options.packet_size))
+    server.daemon = True
+    server.start()
+
+    client = t2jrbot.rcon.Client("127.0.0.1", port, "secret",
+                                 packet_timeout=options.packet_timeout)
+    assert client.query("status") == _STATUS
+
+    native = measure(lambda: client.query("status"), options.rounds)
+    print("native     %8.1f ms" % (native * 1000))
+
+    crcon = distutils.spawn.find_executable("crcon")
+    if crcon:
+        args = [crcon, "-p", "secret", "-P", str(port), "127.0.0.1", "status"]
+        name = "crcon"
+    else:
+        args = [sys.executable, "-c", _ONESHOT, "127.0.0.1", str(port)]
+        name = "subprocess"
+    subproc = measure(lambda: subprocess.check_output(args), options.rounds)
+    print("%-10s %8.1f ms" % (name, subproc * 1000))
+
+if __name__ == "__main__":
+    main()
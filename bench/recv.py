@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# t2jrbot - simple but elegant IRC bot
+# Copyright © 2014 Tuomas Räsänen <tuomasjjrasanen@tjjr.fi>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import time
+
+import t2jrbot.core
+
+class _BurstSocket(object):
+    """Fake socket which hands out a prerecorded burst in small reads."""
+
+    def __init__(self, data):
+        self.__data = data
+        self.__offset = 0
+
+    def recv_into(self, view):
+        chunk = self.__data[self.__offset:self.__offset + len(view)]
+        view[:len(chunk)] = chunk
+        self.__offset += len(chunk)
+        return len(chunk)
+
+def make_burst(lines):
+    msgs = []
+    for i in range(lines):
+        msgs.append(":irc.example.org 353 t2jrbot = #t2jrbot :"
+                    "nick%d nick%d @op%d +voice%d" % (i, i + 1, i, i))
+    return "".join(["%s%s" % (msg, t2jrbot.core.CRLF) for msg in msgs])
+
+def frame_legacy(data, recv_size):
+    # The string-concatenating framer IRC.recv used before LineFramer.
+    lines = 0
+    recvbuf = ""
+    for offset in range(0, len(data), recv_size):
+        recvbuf += data[offset:offset + recv_size]
+        while True:
+            msg, sep, recvbuf = recvbuf.partition(t2jrbot.core.CRLF)
+            if sep != t2jrbot.core.CRLF:
+                recvbuf = msg
+                break
+            lines += 1
+    return lines
+
+def frame(data, recv_size):
+    lines = 0
+    sock = _BurstSocket(data)
+    framer = t2jrbot.core.LineFramer(recv_size)
+    while framer.fill(sock):
+        for _ in framer:
+            lines += 1
+    return lines
+
+def measure(name, func, data, recv_size, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.time()
+        lines = func(data, recv_size)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    print("%-8s %8d lines %10.0f msgs/s" % (name, lines, lines / best))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark IRC line framing")
+    parser.add_argument("--lines", type=int, default=10000,
+                        help="number of lines in the burst")
+    parser.add_argument("--recv-size", type=int, default=4096,
+                        help="bytes read per recv call")
+    parser.add_argument("--rounds", type=int, default=5,
+                        help="number of rounds, the best one is reported")
+    return parser.parse_args()
+
+def main():
+    options = parse_args()
+
+    data = make_burst(options.lines)
+
+    measure("legacy", frame_legacy, data, options.recv_size, options.rounds)
+    measure("framer", frame, data, options.recv_size, options.rounds)
+
+if __name__ == "__main__":
+    main()
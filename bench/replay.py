@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# t2jrbot - simple but elegant IRC bot
+# Copyright © 2014 Tuomas Räsänen <tuomasjjrasanen@tjjr.fi>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import os
+import socket
+import sys
+import threading
+import time
+
+import t2jrbot.capture
+import t2jrbot.core
+
+_END_COMMAND = "BENCHEND"
+
+class _FakeServer(object):
+    """Local IRC server replaying lines to the first client."""
+
+    def __init__(self, lines, speed):
+        self.__lines = lines # List of (delay, line) pairs.
+        self.__speed = speed
+        self.__sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.__sock.bind(("127.0.0.1", 0))
+        self.__sock.listen(1)
+        self.port = self.__sock.getsockname()[1]
+        self.outbound_bytes = 0
+        self.outbound_lines = 0
+        self.__thread = threading.Thread(target=self.__serve)
+        self.__thread.daemon = True
+
+    def start(self):
+        self.__thread.start()
+
+    def join(self):
+        self.__thread.join()
+
+    def __read_client(self, conn):
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            self.outbound_bytes += len(data)
+            self.outbound_lines += data.count(t2jrbot.core.CRLF)
+
+    def __serve(self):
+        conn, _ = self.__sock.accept()
+        reader = threading.Thread(target=self.__read_client, args=(conn,))
+        reader.daemon = True
+        reader.start()
+
+        conn.sendall(":bench.example.org 001 t2jrbot :Welcome%s"
+                     % t2jrbot.core.CRLF)
+
+        chunk = []
+        for delay, line in self.__lines:
+            if self.__speed and delay * self.__speed >= 0.001:
+                conn.sendall("".join(chunk))
+                chunk = []
+                time.sleep(delay * self.__speed)
+            chunk.append("%s%s" % (line, t2jrbot.core.CRLF))
+            if len(chunk) >= 256:
+                conn.sendall("".join(chunk))
+                chunk = []
+        chunk.append(":bench.example.org %s%s" % (_END_COMMAND, t2jrbot.core.CRLF))
+        conn.sendall("".join(chunk))
+
+        reader.join()
+        conn.close()
+
+def synthetic_flood(count):
+    lines = []
+    for i in range(count):
+        n = i % 100
+        kind = i % 10
+        if kind == 0:
+            line = ":user%d!user@host%d.example.org JOIN #bench" % (n, n)
+        elif kind == 1:
+            line = ":user%d!user@host%d.example.org PART #bench :bye" % (n, n)
+        elif kind == 2:
+            line = ":user%d!user@host%d.example.org PRIVMSG #bench :t2jrbot: !help" % (n, n)
+        elif kind == 3:
+            line = "PING :bench.example.org"
+        else:
+            line = (":user%d!user@host%d.example.org PRIVMSG #bench :"
+                    "just chatting about things number %d" % (n, n, i))
+        lines.append((0, line))
+    return lines
+
+def load_plugins(config_file, plugin_names):
+    if config_file:
+        import yaml # Needed only when a config is given.
+        with open(config_file) as f:
+            return yaml.safe_load(f).get("plugins", {})
+    plugins = collections.OrderedDict()
+    for name in plugin_names:
+        plugins[name] = None
+    return plugins
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0
+    i = min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))
+    return sorted_values[i]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay IRC traffic against a bot")
+    parser.add_argument("--capture", metavar="FILE",
+                        help="capture file to replay, recorded with capture_file")
+    parser.add_argument("--flood", type=int, default=10000,
+                        help="number of synthetic lines if no capture is given")
+    parser.add_argument("--speed", type=float, default=0,
+                        help="multiplier for recorded delays, 0 replays as fast as possible")
+    parser.add_argument("--config", metavar="FILE",
+                        help="YAML file with a 'plugins' mapping like t2jrbot.yaml")
+    parser.add_argument("--plugin", dest="plugins", action="append",
+                        help="plugin to load without configuration, "
+                        "can be given multiple times")
+    parser.add_argument("--send-rate", type=float, default=1000000,
+                        help="messages per second the bot may send")
+    return parser.parse_args()
+
+def main():
+    options = parse_args()
+
+    if options.capture:
+        lines = list(t2jrbot.capture.read_capture(options.capture))
+    else:
+        lines = synthetic_flood(options.flood)
+
+    plugin_names = options.plugins or ["t2jrbot.plugins.command",
+                                       "t2jrbot.plugins.pong"]
+    plugins = load_plugins(options.config, plugin_names)
+
+    server = _FakeServer(lines, options.speed)
+    server.start()
+
+    latencies = []
+    stats = {}
+
+    real_stdout = sys.stdout
+    with open(os.devnull, "w") as devnull:
+        # Do not let logging to a terminal dominate the results.
+        sys.stdout = devnull
+        try:
+            with t2jrbot.core.Bot("t2jrbot", plugins,
+                                  send_rate=options.send_rate,
+                                  send_burst=int(options.send_rate)) as bot:
+                dispatch_message = bot.dispatch_message
+
+                def timed_dispatch_message(message, irc=None):
+                    start = time.time()
+                    # Bot.dispatch_message() calls itself through the
+                    # instance to set the current connection, call the
+                    # original directly to time each message once.
+                    bot.call_with_irc(irc, dispatch_message, message)
+                    latencies.append(time.time() - start)
+                    if "start" not in stats:
+                        stats["start"] = start
+                bot.dispatch_message = timed_dispatch_message
+
+                bot.add_irc_callback(lambda prefix, command, params: bot.stop(),
+                                     command=_END_COMMAND)
+                bot.run("127.0.0.1", server.port)
+                stats["end"] = time.time()
+        finally:
+            sys.stdout = real_stdout
+
+    # Wait until all outbound traffic has been counted.
+    server.join()
+
+    # The sentinel is not part of the replayed traffic.
+    count = len(latencies) - 1
+    elapsed = stats["end"] - stats["start"]
+    latencies.sort()
+
+    print("messages        %10d" % count)
+    print("elapsed         %10.3f s" % elapsed)
+    print("throughput      %10.0f msgs/s" % (count / elapsed))
+    for p in (50, 90, 99, 99.9):
+        print("latency p%-5s  %10.1f us" % (p, percentile(latencies, p) * 1e6))
+    print("outbound lines  %10d" % server.outbound_lines)
+    print("outbound bytes  %10d" % server.outbound_bytes)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+# t2jrbot - simple but elegant IRC bot
+# Copyright © 2014 Tuomas Räsänen <tuomasjjrasanen@tjjr.fi>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import gzip
+import struct
+import time
+
+# Each record is the delay since the previous record in microseconds
+# and the length of the line, followed by the line itself.
+_RECORD = struct.Struct(">IH")
+
+_MAX_DELAY = 2 ** 32 - 1
+
+class Recorder(object):
+    """Write received IRC lines to a compact, gzipped capture file."""
+
+    def __init__(self, path):
+        self.__file = gzip.open(path, "wb")
+        self.__last_time = None
+
+    def close(self):
+        self.__file.close()
+
+    def write(self, line):
+        now = time.time()
+        if self.__last_time is None:
+            delay = 0
+        else:
+            delay = min(int((now - self.__last_time) * 1000000), _MAX_DELAY)
+        self.__last_time = now
+        self.__file.write(_RECORD.pack(delay, len(line)))
+        self.__file.write(line)
+
+def read_capture(path):
+    """Iterate (delay, line) pairs of a capture file.
+
+    Delay is the time in seconds since the previous line.
+
+    """
+    with gzip.open(path, "rb") as f:
+        while True:
+            header = f.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                break
+            delay, length = _RECORD.unpack(header)
+            yield delay / 1000000, f.read(length)
@@ -20,83 +20,540 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import datetime
+import collections
+import errno
+import fcntl
+import heapq
 import importlib
+import itertools
+import operator
+import os
+import random
 import select
 import socket
 import sys
+import threading
+import time
+import types
+
+import t2jrbot.log
+import t2jrbot.net
+import t2jrbot.stats
 
 CRLF = "\r\n"
 
 class Error(Exception):
     pass
 
+class LineFramer(object):
+    """Split a stream of bytes into CRLF-terminated lines.
+
+    Received bytes are read directly into a preallocated buffer with
+    `recv_into()` and all complete lines are split out of it at once,
+    without copying the incomplete rest. Incomplete lines longer than
+    `max_line_len` bytes are considered a protocol violation.
+
+    """
+
+    def __init__(self, recv_size=4096, max_line_len=8192):
+        if recv_size <= 0:
+            raise ValueError("recv_size must be positive")
+        if max_line_len <= 0:
+            raise ValueError("max_line_len must be positive")
+        self.__recv_size = recv_size
+        self.__max_line_len = max_line_len
+        self.__buf = bytearray(max_line_len + recv_size)
+        self.__view = memoryview(self.__buf)
+        self.__start = 0 # Start of the first unconsumed byte.
+        self.__end = 0   # End of the received data.
+
+    def __len__(self):
+        return self.__end - self.__start
+
+    def __compact(self):
+        if len(self.__buf) - self.__end >= self.__recv_size:
+            return
+        # Move the incomplete line to the beginning of the buffer to
+        # make room for the next read. This is done at most once per
+        # read and moves at most max_line_len bytes.
+        pending = self.__end - self.__start
+        self.__buf[:pending] = self.__buf[self.__start:self.__end]
+        self.__start = 0
+        self.__end = pending
+
+    def fill(self, sock):
+        """Read at most recv_size bytes from `sock` into the buffer.
+
+        Return the number of bytes read, zero means that the peer has
+        closed the connection.
+
+        """
+        self.__compact()
+        view = self.__view[self.__end:self.__end + self.__recv_size]
+        nbytes = sock.recv_into(view)
+        self.__end += nbytes
+        return nbytes
+
+    def __iter__(self):
+        start = self.__start
+        end = self.__buf.rfind(CRLF, start, self.__end)
+        if end == -1:
+            lines = []
+        else:
+            # Split all complete lines at once, it costs much less per
+            # line than finding and copying them one by one.
+            lines = self.__view[start:end].tobytes().split(CRLF)
+            start = end + 2
+        pending = self.__end - start
+        if not pending:
+            self.__start = self.__end = 0
+        elif pending > self.__max_line_len:
+            self.__start = self.__end = 0
+            raise Error("received line is too long", pending)
+        else:
+            self.__start = start
+        return iter(lines)
+
+_TAG_ESCAPES = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
+
+def _unescape_tag_value(value):
+    if "\\" not in value:
+        return value
+    chars = []
+    i = 0
+    while i < len(value):
+        c = value[i]
+        if c == "\\":
+            i += 1
+            if i < len(value):
+                c = _TAG_ESCAPES.get(value[i], value[i])
+            else:
+                c = ""
+        chars.append(c)
+        i += 1
+    return "".join(chars)
+
+# parse_message() builds Messages with this, skipping Message.__new__().
+_new_message = tuple.__new__
+
+class Message(tuple):
+    """Received IRC message.
+
+    A (prefix, command, params) tuple. Prefix components and IRCv3
+    message tags are parsed only when accessed.
+
+    """
+
+    # A tuple is built without running Python code and needs no
+    # per-instance dict.
+    __slots__ = ()
+
+    def __new__(cls, prefix, command, params, tagstr=""):
+        if tagstr:
+            return _TaggedMessage(prefix, command, params, tagstr)
+        return tuple.__new__(cls, (prefix, command, params))
+
+    prefix = property(operator.itemgetter(0))
+    command = property(operator.itemgetter(1))
+    params = property(operator.itemgetter(2))
+
+    def __repr__(self):
+        return "Message(%r, %r, %r)" % self
+
+    # Splitting the prefix when needed is cheaper than caching its
+    # parts.
+
+    @property
+    def nick(self):
+        return self[0].partition("!")[0]
+
+    @property
+    def userhost(self):
+        """The part of the prefix after the nick, i.e. user@host."""
+        return self[0].partition("!")[2]
+
+    @property
+    def user(self):
+        return self[0].partition("!")[2].partition("@")[0]
+
+    @property
+    def host(self):
+        return self[0].partition("!")[2].partition("@")[2]
+
+    @property
+    def tags(self):
+        """IRCv3 message tags as a dict, valueless tags map to ''."""
+        return {}
+
+class _TaggedMessage(Message):
+    # Few messages carry tags, only they pay for storing them.
+
+    def __new__(cls, prefix, command, params, tagstr):
+        message = tuple.__new__(cls, (prefix, command, params))
+        message.__tagstr = tagstr
+        message.__tags = None
+        return message
+
+    @property
+    def tags(self):
+        if self.__tags is None:
+            tags = {}
+            for tag in self.__tagstr.split(";"):
+                key, _, value = tag.partition("=")
+                tags[key] = _unescape_tag_value(value)
+            self.__tags = tags
+        return self.__tags
+
+def parse_message(msg):
+    """Parse a received IRC line to a Message."""
+    # Comparing a one-character slice is cheaper than startswith().
+    if msg[:1] == "@":
+        tagstr, _, msg = msg[1:].partition(" ")
+    else:
+        tagstr = None
+
+    if msg[:1] == ":":
+        prefix, sep, msg = msg.partition(" ")
+        prefix = prefix[1:]
+        if not sep:
+            raise Error("received message has malformed prefix", sep)
+    else:
+        prefix = ""
+
+    command, _, paramstr = msg.partition(" ")
+
+    if paramstr[:1] == ":":
+        params = [paramstr[1:]]
+    else:
+        middle, sep, trailing = paramstr.partition(" :")
+        params = middle.split()
+        if sep:
+            params.append(trailing)
+
+    if tagstr:
+        return _TaggedMessage(prefix, command, params, tagstr)
+    return _new_message(Message, (prefix, command, params))
+
+class TokenBucket(object):
+    """Rate limiter allowing `burst` events at once and `rate` events
+    per second on average."""
+
+    def __init__(self, rate, burst):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        if burst < 1:
+            raise ValueError("burst must be at least 1")
+        self.__rate = rate
+        self.__burst = burst
+        self.__tokens = burst
+        self.__last_refill = time.time()
+
+    def __refill(self):
+        now = time.time()
+        elapsed = max(0, now - self.__last_refill)
+        self.__tokens = min(self.__burst, self.__tokens + elapsed * self.__rate)
+        self.__last_refill = now
+
+    def consume(self, force=False):
+        """Take a token if one is available and return True.
+
+        If `force` is True, the token is taken even if the bucket is
+        empty, which delays subsequent events.
+
+        """
+        self.__refill()
+        if self.__tokens >= 1 or force:
+            self.__tokens -= 1
+            return True
+        return False
+
+    def delay(self):
+        """Return seconds until the next token is available."""
+        self.__refill()
+        return max(0, (1 - self.__tokens) / self.__rate)
+
+def split_text(text, max_len):
+    """Split a byte string to chunks of at most `max_len` bytes.
+
+    Text is split at spaces where possible. Words longer than
+    `max_len` are split, but never in the middle of an UTF-8
+    character.
+
+    """
+    chunks = []
+    while len(text) > max_len:
+        i = text.rfind(" ", 0, max_len + 1)
+        if i > 0:
+            chunk, text = text[:i], text[i + 1:]
+        else:
+            i = max_len
+            # Back off from UTF-8 continuation bytes.
+            while i > 0 and (ord(text[i]) & 0xC0) == 0x80:
+                i -= 1
+            if i == 0:
+                i = max_len
+            chunk, text = text[:i], text[i:]
+        chunk = chunk.rstrip(" ")
+        if chunk:
+            chunks.append(chunk)
+    if text:
+        chunks.append(text)
+    return chunks
+
+def pack_texts(texts, max_len, separator=" | "):
+    """Pack texts to as few lines of at most `max_len` bytes as possible.
+
+    The order of texts is kept. Texts are joined with `separator` and
+    split with split_text() if they do not fit on a line.
+
+    """
+    lines = []
+    line = None
+    for text in texts:
+        for chunk in split_text(text, max_len):
+            if line is not None and len(line) + len(separator) + len(chunk) <= max_len:
+                line = "%s%s%s" % (line, separator, chunk)
+                continue
+            if line is not None:
+                lines.append(line)
+            line = chunk
+    if line is not None:
+        lines.append(line)
+    return lines
+
+def _encode(text):
+    if isinstance(text, unicode):
+        return text.encode("utf-8")
+    return text
+
+def _would_block(e):
+    """Return True if socket error `e` means that the call should be
+    retried when the socket is ready."""
+    # Only TLS connections raise SSL errors, and they have imported
+    # ssl already.
+    ssl = sys.modules.get("ssl")
+    if ssl is not None and isinstance(e, (ssl.SSLWantReadError,
+                                          ssl.SSLWantWriteError)):
+        return True
+    return e.errno in (errno.EAGAIN, errno.EWOULDBLOCK)
+
 class IRC(object):
 
     MAX_MSG_LEN = 510
 
-    def __init__(self):
-        self.__recvbuf = ""
-        self.__sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Servers prepend ":nick!user@host " to messages they relay, the
+    # result must fit in MAX_MSG_LEN. Until the bot has seen its own
+    # user@host, this much is reserved for it (USERLEN 10 and HOSTLEN
+    # 63 of common servers).
+    MAX_USERHOST_LEN = 10 + 1 + 63
 
-    def close(self):
-        self.__sock.close()
+    DRAIN_TIMEOUT = 5
 
-    def connect(self, server, port):
-        self.__sock.connect((server, port))
+    # Priority lanes of the send queue. High priority messages bypass
+    # the rate limiter.
+    PRIORITY_HIGH = 0
+    PRIORITY_NORMAL = 1
+    PRIORITY_LOW = 2
 
-    def fileno(self):
-        return self.__sock.fileno()
+    DEFAULT_NAME = "default"
 
-    def __recv(self, msg):
-        prefix = ""
+    def __init__(self, recv_size=4096, max_line_len=8192,
+                 send_rate=0.5, send_burst=5, log=None,
+                 name=DEFAULT_NAME, nick=None):
+        if log is None:
+            log = t2jrbot.log.Log()
+        self.log = log
+        self.name = name
+        self.nick = nick
+        # user@host of the bot as seen by others, if known.
+        self.userhost = None
+        # (server, port) pairs to connect to, tried in turn.
+        self.servers = []
+        self.tls = False
+        self.tls_verify = True
+        self.server = None
+        self.port = None
+        self.is_connected = False
+        # The default connection is logged without its name.
+        self.__log_network = None if name == IRC.DEFAULT_NAME else name
+        self.__recv_size = recv_size
+        self.__max_line_len = max_line_len
+        self.__framer = None
+        self.__sock = None
+        self.__pending = None
 
-        if msg.startswith(":"):
-            prefix, sep, msg = msg.partition(" ")
-            prefix = prefix[1:]
-            if sep != " ":
-                raise Error("received message has malformed prefix", sep)
+        self.__send_lock = threading.Lock()
+        self.__send_queues = (collections.deque(),
+                              collections.deque(),
+                              collections.deque())
+        self.__send_queued = 0
+        self.__send_rate = send_rate
+        self.__send_burst = send_burst
+        self.__send_bucket = TokenBucket(send_rate, send_burst)
+        self.__sendbuf = bytearray()
 
-        command, _, paramstr = msg.partition(" ")
+        # Called, possibly from other threads, when a message is
+        # queued to an empty send queue or with high priority.
+        self.on_send_pending = None
 
-        params = []
-        while paramstr:
-            if paramstr.startswith(":"):
-                param = paramstr[1:]
-                paramstr = ""
-            else:
-                param, _, paramstr = paramstr.partition(" ")
-            params.append(param)
+        # If set, received lines are written to this
+        # t2jrbot.capture.Recorder.
+        self.recorder = None
+
+    def close(self):
+        if self.__sock is not None:
+            self.__sock.close()
+        if self.recorder is not None:
+            self.recorder.close()
 
-        return prefix, command, params
+    def connect(self, server, port, sock=None):
+        """Connect to `server`, or use `sock` already connected to it.
+
+        Whatever was left from a previous connection, including
+        unsent messages, is discarded.
+
+        """
+        if self.__sock is not None:
+            self.__sock.close()
+        self.server = server
+        self.port = port
+        self.userhost = None
+        self.__framer = LineFramer(self.__recv_size, self.__max_line_len)
+        with self.__send_lock:
+            for queue in self.__send_queues:
+                queue.clear()
+            self.__send_queued = 0
+        # Flood limits are per connection, so a new one starts with a
+        # full burst.
+        self.__send_bucket = TokenBucket(self.__send_rate, self.__send_burst)
+        del self.__sendbuf[:]
+        if sock is None:
+            sock = socket.create_connection((server, port))
+        self.__sock = sock
+        self.__sock.setblocking(False)
+        # TLS sockets might have decrypted data buffered which select()
+        # does not know about.
+        self.__pending = getattr(sock, "pending", None)
+        self.is_connected = True
+
+    def fileno(self):
+        return self.__sock.fileno()
 
     def recv(self):
-        retval = []
+        """Read the socket and return an iterator over received messages.
+
+        Messages are parsed lazily, one at a time, while the iterator
+        is consumed.
+
+        """
+        try:
+            nbytes = self.__framer.fill(self.__sock)
+        except socket.error, e:
+            if not _would_block(e):
+                raise
+            return iter(())
 
-        recvbuf = self.__sock.recv(4096)
-        if not recvbuf:
+        if not nbytes:
             raise Error("receive failed, connection reset by peer")
 
-        # Concatenate old and new bufs.
-        self.__recvbuf += recvbuf
+        return self.__iter_messages()
 
+    def __iter_messages(self):
         while True:
-            msg, sep, self.__recvbuf = self.__recvbuf.partition(CRLF)
-            if sep != CRLF:
-                # Save the incomplete msg for later concatenation.
-                self.__recvbuf = msg
+            for msg in self.__framer:
+                if self.recorder is not None:
+                    self.recorder.write(msg)
+                message = parse_message(msg)
+                self.log.rx(message.command, msg, self.__log_network)
+                yield message
+            if self.__pending is None or not self.__pending():
                 break
-            self.__log("<=IRC", msg)
+            # Read what TLS has buffered, the socket will not become
+            # readable for it.
+            self.__framer.fill(self.__sock)
 
-            retval.append(self.__recv(msg))
+    def send(self, msg, priority=PRIORITY_NORMAL):
+        """Queue a message for sending.
 
-        return retval
+        This method is thread-safe. Messages are written by flush()
+        when the socket is writable and the rate limiter permits.
 
-    def send(self, msg):
+        """
         if len(msg) > IRC.MAX_MSG_LEN:
             raise Error("message is too long to send", len(msg))
-        self.__log("=>IRC", msg)
-        self.__sock.sendall("%s%s" % (msg, CRLF))
+        with self.__send_lock:
+            was_empty = not self.__send_queued
+            self.__send_queues[priority].append(msg)
+            self.__send_queued += 1
+        # High priority messages skip the rate limit, so the writer
+        # must be watched even if it is waiting for the bucket to refill.
+        if ((was_empty or priority == IRC.PRIORITY_HIGH)
+            and self.on_send_pending is not None):
+            self.on_send_pending()
+
+    def __dequeue(self, ignore_rate=False):
+        msgs = []
+        with self.__send_lock:
+            for priority, queue in enumerate(self.__send_queues):
+                force = ignore_rate or priority == IRC.PRIORITY_HIGH
+                while queue and self.__send_bucket.consume(force):
+                    msgs.append(queue.popleft())
+                if queue:
+                    # Lower priority messages must wait until higher
+                    # ones are sent.
+                    break
+            self.__send_queued -= len(msgs)
+        for msg in msgs:
+            self.log.tx(msg.partition(" ")[0], msg, self.__log_network)
+        return "".join(["%s%s" % (msg, CRLF) for msg in msgs])
+
+    def flush(self):
+        """Write as many queued messages as the rate limiter permits.
+
+        All messages are coalesced into a single send call. Whatever
+        the socket does not accept is written on the next call.
+
+        """
+        self.__sendbuf += self.__dequeue()
+        if not self.__sendbuf:
+            return
+        try:
+            nbytes = self.__sock.send(self.__sendbuf)
+        except socket.error, e:
+            if not _would_block(e):
+                raise
+            return
+        del self.__sendbuf[:nbytes]
+
+    def send_delay(self):
+        """Return seconds until flush() should be called next.
+
+        None means that there is nothing to send, zero means that
+        flush() should be called as soon as the socket is writable.
+
+        """
+        if self.__sendbuf:
+            return 0
+        with self.__send_lock:
+            if not self.__send_queued:
+                return None
+            if self.__send_queues[IRC.PRIORITY_HIGH]:
+                return 0
+            return self.__send_bucket.delay()
+
+    def drain(self):
+        """Write all queued messages ignoring the rate limiter.
+
+        Blocks at most DRAIN_TIMEOUT seconds.
+
+        """
+        self.__sendbuf += self.__dequeue(ignore_rate=True)
+        self.__sock.settimeout(IRC.DRAIN_TIMEOUT)
+        try:
+            self.__sock.sendall(self.__sendbuf)
+        finally:
+            self.__sock.setblocking(False)
+        del self.__sendbuf[:]
 
     def send_join(self, channel):
         self.send("JOIN %s" % channel)
@@ -104,24 +561,42 @@ class IRC(object):
     def send_nick(self, nick):
         self.send("NICK %s" % nick)
 
-    def send_pong(self, nick):
-        self.send("PONG %s" % nick)
+    def send_ping(self, token):
+        self.send("PING :%s" % token, IRC.PRIORITY_HIGH)
 
-    def send_privmsg(self, target, text):
-        head = "PRIVMSG %s :" % target
-        max_tail_len = IRC.MAX_MSG_LEN - len(head)
+    def send_pong(self, token):
+        self.send("PONG :%s" % token, IRC.PRIORITY_HIGH)
+
+    def __max_privmsg_text_len(self, head):
+        if self.userhost is None:
+            userhost_len = IRC.MAX_USERHOST_LEN
+        else:
+            userhost_len = len(self.userhost)
+        # ":nick!user@host " is prepended by the server.
+        prefix_len = 1 + len(self.nick or "") + 1 + userhost_len + 1
+        return IRC.MAX_MSG_LEN - prefix_len - len(head)
 
-        i = 0
-        while i < len(text):
-            tail = text[i:i+max_tail_len]
-            self.send("%s%s" % (head, tail))
-            i += len(tail)
+    def send_privmsg(self, target, text, priority=PRIORITY_NORMAL):
+        """Send text, split at word boundaries to fit in messages."""
+        head = "PRIVMSG %s :" % _encode(target)
+        max_text_len = self.__max_privmsg_text_len(head)
+        for chunk in split_text(_encode(text), max_text_len):
+            self.send("%s%s" % (head, chunk), priority)
+
+    def send_privmsgs(self, target, texts, priority=PRIORITY_NORMAL,
+                      separator=" | "):
+        """Send several texts packed to as few messages as possible."""
+        head = "PRIVMSG %s :" % _encode(target)
+        max_text_len = self.__max_privmsg_text_len(head)
+        for line in pack_texts([_encode(t) for t in texts], max_text_len,
+                               _encode(separator)):
+            self.send("%s%s" % (head, line), priority)
 
     def send_quit(self, reason):
         quit_msg = "QUIT"
         if reason:
             quit_msg += " :%s" % reason
-        self.send(quit_msg)
+        self.send(quit_msg, IRC.PRIORITY_HIGH)
 
     def send_topic(self, channel, topic=None):
         if topic is None:
@@ -133,40 +608,464 @@ class IRC(object):
         self.send("USER %s 0 * :%s" % (user, realname))
 
     def shutdown(self):
-        self.__sock.shutdown(socket.SHUT_RDWR)
+        self.is_connected = False
+        try:
+            self.__sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            # The peer might have closed the connection already.
+            pass
+
+class Future(object):
+    """Result of an operation which completes later in the loop."""
+
+    def __init__(self):
+        self.is_done = False
+        self.result = None
+        self.exception = None
+        self.__callbacks = []
+
+    def __finish(self):
+        self.is_done = True
+        callbacks = self.__callbacks
+        self.__callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+    def set_result(self, result):
+        self.result = result
+        self.__finish()
+
+    def set_exception(self, exception):
+        self.exception = exception
+        self.__finish()
+
+    def add_done_callback(self, callback):
+        """Call `callback` with the future when it is done."""
+        if self.is_done:
+            callback(self)
+        else:
+            self.__callbacks.append(callback)
+
+class Timer(object):
+
+    def __init__(self, when, func, args, irc):
+        self.when = when
+        self.func = func
+        self.args = args
+        self.irc = irc
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class _Dispatch(object):
+    # IRC callbacks matching a (prefix, command) pair and their
+    # histograms. A single countdown both counts the messages and
+    # picks the ones whose callbacks are timed.
+
+    __slots__ = ("callbacks", "histograms", "countdown", "gap")
+
+    def __init__(self, callbacks, histograms):
+        self.callbacks = callbacks
+        self.histograms = histograms
+        self.countdown = self.gap = t2jrbot.stats.sample_gap()
+
+    def collect(self):
+        """Add messages dispatched since the last call to histograms."""
+        count = self.gap - self.countdown
+        self.gap = self.countdown
+        for histogram in self.histograms:
+            histogram.count += count
 
-    def __log(self, name, msg):
-        timestamp = datetime.datetime.utcnow().isoformat()
-        print(timestamp, name, msg)
+    def restart(self):
+        self.collect()
+        self.countdown = self.gap = t2jrbot.stats.sample_gap()
+
+def _fileno(fileobj):
+    if isinstance(fileobj, (int, long)):
+        return fileobj
+    return fileobj.fileno()
 
 class Bot(object):
 
-    def __init__(self, nick, plugins):
-        self.irc = IRC()
-        self.nick = nick
+    MAX_DISPATCH_CACHE_SIZE = 1024
+
+    # Bounds of the reconnection delay, which doubles on every failed
+    # attempt and is randomized to spread reconnecting bots apart.
+    RECONNECT_MIN_DELAY = 1
+    RECONNECT_MAX_DELAY = 300
+
+    # Connection attempts to different addresses of a server are
+    # started this many seconds apart, and each is given up after
+    # CONNECT_TIMEOUT seconds.
+    CONNECT_ATTEMPT_DELAY = 0.25
+    CONNECT_TIMEOUT = 10
+
+    def __init__(self, nick, plugins, send_rate=0.5, send_burst=5, log=None,
+                 reconnect=True):
+        if log is None:
+            log = t2jrbot.log.Log()
+        self.log = log
+        self.__send_rate = send_rate
+        self.__send_burst = send_burst
+
+        # If True, lost connections are connected again, otherwise
+        # errors end run().
+        self.__reconnect = reconnect
+        # Map connections to the numbers of failed connection attempts
+        # since they were last registered, the index of the server to
+        # connect next and the time the current connection attempt
+        # started.
+        self.__connect_failures = {}
+        self.__server_indices = {}
+        self.__connect_times = {}
+        # Connections which are waiting for the first own JOIN.
+        self.__joining = set()
+        # Maps connections to their t2jrbot.net.Connector while connecting.
+        self.__connectors = {}
+        self.__connect_callbacks = []
+
+        # Maps names to IRC connections.
+        self.__connections = collections.OrderedDict()
+        self.__irc_writers_added = set()
+
+        # The connection whose message is being handled, None means
+        # the default connection.
+        self.__current_irc = None
+        self.__loop_thread = threading.current_thread()
+
+        self.current_message = None
+        self.stats = t2jrbot.stats.Stats()
+        self.stats.add_collector(self.__collect_dispatch_counts)
         self.__is_stopping = False
         self.__plugins = {}
+        self.__plugin_confs = {}
+        # Maps plugin names to lists of (func, args) tuples undoing
+        # what the plugin registered while it was being loaded.
+        self.__plugin_release_callbacks = {}
+        self.__loading_plugin = None
 
-        self.__irc_callbacks_index_map = {}
+        # List of (callback, prefix, command) tuples in the order they
+        # were added.
         self.__irc_callbacks = []
 
-        self.add_irc_callback(self.__irc_error, command="ERROR")
+        # Maps (prefix, command) pairs to _Dispatch objects.
+        self.__irc_dispatch_cache = {}
+
+        # Heap of (when, seq, timer) tuples.
+        self.__timers = []
+        self.__timer_seq = itertools.count()
+
+        # Map file descriptors to callbacks.
+        self.__readers = {}
+        self.__writers = {}
 
-        for plugin_name, plugin_conf in plugins.items():
-            if plugin_conf is None:
-                plugin_conf = {}
+        # Calls scheduled with call_soon(), possibly from other
+        # threads. The pipe wakes up the loop from select().
+        self.__pending_calls = collections.deque()
+        self.__pending_calls_lock = threading.Lock()
+        self.__wakeup_rpipe, self.__wakeup_wpipe = os.pipe()
+        for fd in (self.__wakeup_rpipe, self.__wakeup_wpipe):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.add_reader(self.__wakeup_rpipe, self.__wakeup)
 
-            plugin_module = importlib.import_module(plugin_name)
-            plugin = plugin_module.load(self, plugin_conf)
-            self.__plugins[plugin_name] = plugin
+        self.__default_irc = self.add_connection(IRC.DEFAULT_NAME, nick)
+
+        self.add_irc_callback(self.__irc_error, command="ERROR")
+        self.add_irc_callback(self.__irc_001, command="001")
+        self.add_irc_callback(self.__irc_join, command="JOIN")
+
+        self.__load_plugins(plugins)
 
     def __irc_error(self, prefix, this_command, params):
-        sys.exit(1)
+        if not self.__reconnect:
+            sys.exit(1)
+        # The server closes the link after ERROR.
+        self.__connection_lost(self.irc, "ERROR %s" % " ".join(params))
+
+    def __irc_001(self, prefix, this_command, params):
+        irc = self.irc
+        self.__connect_failures.pop(irc, None)
+        start = self.__connect_times.get(irc)
+        if start is not None:
+            elapsed = time.time() - start
+            self.stats.histogram("connect:registered").add(elapsed)
+            self.log.info("IRC", "%s: registered in %.1f ms"
+                          % (irc.name, elapsed * 1000))
+            self.__joining.add(irc)
+        for callback in list(self.__connect_callbacks):
+            callback()
+
+    def __irc_join(self, prefix, this_command, params):
+        # The server echoes our own JOINs, learn how others see us to
+        # know how long messages can be.
+        message = self.current_message
+        irc = self.irc
+        if message.nick != irc.nick:
+            return
+        if message.userhost:
+            irc.userhost = message.userhost
+        if irc in self.__joining:
+            self.__joining.discard(irc)
+            elapsed = time.time() - self.__connect_times[irc]
+            self.stats.histogram("connect:joined").add(elapsed)
+            self.log.info("IRC", "%s: joined in %.1f ms"
+                          % (irc.name, elapsed * 1000))
+
+    def add_connect_callback(self, callback):
+        """Add a callable called when a connection is registered.
+
+        The callback is called without arguments, with the connection
+        as the current connection, after each successful connection
+        and reconnection, before the 001 IRC callbacks. Plugins use it
+        to resynchronize state which was lost with the connection.
+
+        """
+        self.__connect_callbacks.append(callback)
+        self.add_release_callback(self.remove_connect_callback, callback)
+
+    def remove_connect_callback(self, callback):
+        try:
+            self.__connect_callbacks.remove(callback)
+        except ValueError:
+            raise Error("connect callback is not registered", callback)
 
     @property
     def plugins(self):
         return dict(self.__plugins)
 
+    def __import_plugin(self, name):
+        start = time.time()
+        module = importlib.import_module(name)
+        elapsed = time.time() - start
+        self.stats.histogram("import:%s" % name).add(elapsed)
+        self.log.info("PLUGIN", "%s imported in %.1f ms" % (name, elapsed * 1000))
+        return module
+
+    def __load_plugins(self, plugins):
+        # Plugin modules declare the plugins they need to be loaded
+        # first in DEPENDENCIES. Dependencies which are not configured
+        # are loaded with an empty configuration.
+        start = time.time()
+        modules = {}
+        order = []
+        path = [] # Plugins being visited, to detect cycles.
+
+        def visit(name):
+            if name in modules:
+                if name in path:
+                    cycle = path[path.index(name):] + [name]
+                    raise Error("plugin dependency cycle: %s" % " -> ".join(cycle))
+                return
+            modules[name] = module = self.__import_plugin(name)
+            path.append(name)
+            for dependency in sorted(getattr(module, "DEPENDENCIES", ())):
+                visit(dependency)
+            path.pop()
+            order.append(name)
+
+        # Sorted to load in the same order every time.
+        for name in sorted(plugins):
+            visit(name)
+
+        for name in order:
+            conf = plugins.get(name)
+            if conf is None:
+                conf = {}
+            self.__load_plugin_module(name, modules[name], conf)
+
+        self.log.info("PLUGIN", "%d plugins ready in %.1f ms"
+                      % (len(order), (time.time() - start) * 1000))
+
+    def load_plugin(self, name, conf=None):
+        """Import plugin module `name` and load it with `conf`.
+
+        If `conf` is None, the configuration the plugin had when it was
+        last loaded is used, or an empty one.
+
+        IRC callbacks, commands and anything else registered with
+        add_release_callback() while the plugin is loading is removed
+        when the plugin is unloaded.
+
+        """
+        if name in self.__plugins:
+            raise Error("plugin '%s' is already loaded" % name)
+        if conf is None:
+            conf = self.__plugin_confs.get(name, {})
+        module = self.__import_plugin(name)
+        missing = [d for d in getattr(module, "DEPENDENCIES", ())
+                   if d not in self.__plugins]
+        if missing:
+            raise Error("plugin '%s' requires %s" % (name, ", ".join(missing)))
+        self.__load_plugin_module(name, module, conf)
+
+    def __load_plugin_module(self, name, module, conf):
+        self.__plugin_release_callbacks[name] = []
+        self.__loading_plugin = name
+        start = time.time()
+        try:
+            plugin = module.load(self, conf)
+        except:
+            self.__loading_plugin = None
+            self.__run_release_callbacks(name)
+            raise
+        elapsed = time.time() - start
+        self.__loading_plugin = None
+        self.__plugins[name] = plugin
+        self.__plugin_confs[name] = conf
+        self.stats.histogram("load:%s" % name).add(elapsed)
+        self.log.info("PLUGIN", "%s loaded in %.1f ms" % (name, elapsed * 1000))
+
+    def unload_plugin(self, name):
+        """Release plugin `name` and remove what it registered.
+
+        A plugin cannot be unloaded while other loaded plugins list it
+        in their DEPENDENCIES or have registered something with it.
+
+        """
+        self.__check_unloadable(name)
+        plugin = self.__plugins.pop(name)
+        try:
+            plugin.release()
+        finally:
+            self.__run_release_callbacks(name)
+
+    def __check_unloadable(self, name):
+        try:
+            plugin = self.__plugins[name]
+        except KeyError:
+            raise Error("plugin '%s' is not loaded" % name)
+
+        users = set([n for n, callbacks in self.__plugin_release_callbacks.items()
+                     if n != name and any([getattr(func, "__self__", None) is plugin
+                                           for func, _ in callbacks])])
+        users.update([n for n in self.__plugins
+                      if name in getattr(sys.modules.get(n), "DEPENDENCIES", ())])
+        if users:
+            raise Error("plugin '%s' is used by %s"
+                        % (name, ", ".join(sorted(users))))
+
+    def reload_plugin(self, name):
+        """Reload the module of plugin `name` and load the plugin again.
+
+        The plugin is loaded with the configuration it had. The
+        connections stay up. If the new code cannot be imported, the
+        plugin is left as it is. If it cannot be loaded, the plugin is
+        loaded again with the old code.
+
+        """
+        self.__check_unloadable(name)
+        conf = self.__plugin_confs[name]
+        module = sys.modules[name]
+
+        # reload() replaces the contents of the module in place, keep
+        # the old ones to put them back.
+        old_namespace = dict(module.__dict__)
+        start = time.time()
+        try:
+            # Python 2 has no importlib.reload().
+            reload(module)
+        except Exception, e:
+            module.__dict__.clear()
+            module.__dict__.update(old_namespace)
+            raise Error("plugin '%s' was not reloaded: %s" % (name, e))
+        self.stats.histogram("import:%s" % name).add(time.time() - start)
+
+        self.unload_plugin(name)
+        try:
+            self.__load_plugin_module(name, module, conf)
+        except Exception, e:
+            module.__dict__.clear()
+            module.__dict__.update(old_namespace)
+            self.__load_plugin_module(name, module, conf)
+            raise Error("plugin '%s' was not reloaded, loaded the old "
+                        "code again: %s" % (name, e))
+
+    def add_release_callback(self, func, *args):
+        """Call func(*args) when the plugin being loaded is unloaded.
+
+        Plugins offering registrations to other plugins, such as the
+        command plugin, use this to undo them. Outside plugin loading,
+        this does nothing.
+
+        """
+        if self.__loading_plugin is not None:
+            callbacks = self.__plugin_release_callbacks[self.__loading_plugin]
+            callbacks.append((func, args))
+
+    def __run_release_callbacks(self, name):
+        # Undo in the reverse order of registration.
+        for func, args in reversed(self.__plugin_release_callbacks.pop(name, [])):
+            try:
+                func(*args)
+            except Exception, e:
+                # The plugin might have cleaned up itself already.
+                self.log.debug("PLUGIN", "%s: %s" % (name, e))
+
+    @property
+    def irc(self):
+        """The current IRC connection.
+
+        While a message is handled, this is the connection the message
+        was received from, so replies get routed back to it. Calls
+        scheduled and coroutines spawned meanwhile run with the same
+        current connection. Otherwise, and always in other threads,
+        this is the default connection.
+
+        """
+        irc = self.__capture_irc()
+        if irc is None:
+            return self.__default_irc
+        return irc
+
+    @property
+    def nick(self):
+        """The nick on the current IRC connection."""
+        return self.irc.nick
+
+    @nick.setter
+    def nick(self, nick):
+        self.irc.nick = nick
+
+    @property
+    def connections(self):
+        return dict(self.__connections)
+
+    def add_connection(self, name, nick, server=None, port=None):
+        """Add an IRC connection.
+
+        All connections are connected when the bot is run. The default
+        connection connects to the server given to run(). More servers
+        to rotate through on reconnects can be appended to the
+        `servers` list of the returned IRC object.
+
+        """
+        if name in self.__connections:
+            raise Error("connection '%s' already exists" % name)
+        irc = IRC(send_rate=self.__send_rate, send_burst=self.__send_burst,
+                  log=self.log, name=name, nick=nick)
+        if server is not None:
+            irc.servers.append((server, port))
+        irc.on_send_pending = lambda: self.call_soon(self.__irc_watch_writable, irc)
+        self.__connections[name] = irc
+        return irc
+
+    def call_with_irc(self, irc, func, *args):
+        """Call `func` with `args` and `irc` as the current connection."""
+        previous_irc = self.__current_irc
+        self.__current_irc = irc
+        try:
+            return func(*args)
+        finally:
+            self.__current_irc = previous_irc
+
+    def __capture_irc(self):
+        if threading.current_thread() is not self.__loop_thread:
+            # Other threads have no notion of the current connection.
+            return None
+        return self.__current_irc
+
     def stop(self):
         self.__is_stopping = True
 
@@ -178,42 +1077,395 @@ class Bot(object):
         `prefix` and/or `command` is None, they are treated as wildcards
         matching any value.
 
-        Callbacks are called in the order they added to the list.
+        Callbacks are called in the order they added to the list. If a
+        callback is a generator function, the returned generator is run
+        as a coroutine, see spawn().
 
         """
-        i = len(self.__irc_callbacks)
-        self.__irc_callbacks.append(callback)
-        key = (prefix, command)
-        indices = self.__irc_callbacks_index_map.setdefault(key, [])
-        indices.append(i)
+        self.__irc_callbacks.append((callback, prefix, command))
+        self.__clear_irc_dispatch_cache()
+        self.add_release_callback(self.remove_irc_callback, callback,
+                                  prefix, command)
 
-    def run(self, server, port):
-        self.irc.connect(server, port)
+    def remove_irc_callback(self, callback, prefix=None, command=None):
+        """Remove a callable from the list of IRC RX callbacks.
+
+        The callback must have been added with the same `prefix` and
+        `command` with add_irc_callback(). If the callback was added
+        multiple times, only the first one is removed.
+
+        """
         try:
-            # Register connection.
-            self.irc.send_nick(self.nick)
-            self.irc.send_user(self.nick, self.nick)
+            self.__irc_callbacks.remove((callback, prefix, command))
+        except ValueError:
+            raise Error("IRC callback is not registered", callback,
+                        prefix, command)
+        self.__clear_irc_dispatch_cache()
 
-            while not self.__is_stopping:
-                rs, _, _ = select.select([self.irc], [], [])
+    def __resolve_irc_dispatch(self, prefix, command):
+        callbacks = tuple([callback
+                           for callback, cb_prefix, cb_command in self.__irc_callbacks
+                           if cb_prefix in (None, prefix) and cb_command in (None, command)])
+        histograms = tuple([self.stats.histogram("irc:%s" % t2jrbot.stats.callable_name(callback))
+                            for callback in callbacks])
+        if len(self.__irc_dispatch_cache) >= Bot.MAX_DISPATCH_CACHE_SIZE:
+            # Prefixes are practically unbounded, do not let the cache
+            # grow with them.
+            self.__clear_irc_dispatch_cache()
+        dispatch = self.__irc_dispatch_cache[(prefix, command)] = _Dispatch(callbacks, histograms)
+        return dispatch
+
+    def __collect_dispatch_counts(self):
+        for dispatch in self.__irc_dispatch_cache.values():
+            dispatch.collect()
+
+    def __clear_irc_dispatch_cache(self):
+        self.__collect_dispatch_counts()
+        self.__irc_dispatch_cache.clear()
 
-                # Read socket buffer, parse messages and handle them.
-                messages = self.irc.recv()
+    def dispatch_irc_message(self, prefix, command, params):
+        """Call all IRC RX callbacks matching the message."""
+        self.dispatch_message(Message(prefix, command, params))
 
-                for prefix, command, params in messages:
-                    callback_indices = set()
+    def dispatch_message(self, message, irc=None):
+        """Call all IRC RX callbacks matching the Message.
 
-                    callback_indices.update(
-                        self.__irc_callbacks_index_map.get((None, None), set()),
-                        self.__irc_callbacks_index_map.get((prefix, None), set()),
-                        self.__irc_callbacks_index_map.get((None, command), set()),
-                        self.__irc_callbacks_index_map.get((prefix, command), set()))
+        While callbacks are called, the message is available as
+        current_message, giving access to its parsed prefix and tags,
+        and `irc`, the connection the message came from, is the
+        current connection. current_message is left as it is after
+        the callbacks, it is meaningful only while they are running.
+
+        """
+        if irc is not None:
+            self.call_with_irc(irc, self.dispatch_message, message)
+            return
+
+        # This runs for every received message, keep it to a dict
+        # lookup and a loop over callbacks.
+        try:
+            dispatch = self.__irc_dispatch_cache[message[:2]]
+        except KeyError:
+            dispatch = self.__resolve_irc_dispatch(message.prefix, message.command)
+
+        self.current_message = message
+        dispatch.countdown -= 1
+        if not dispatch.countdown:
+            self.__dispatch_timed(dispatch, message)
+            return
+
+        for callback in dispatch.callbacks:
+            result = callback(*message)
+            # Most callbacks return None, which is cheaper to test for
+            # than a generator.
+            if result is not None and isinstance(result, types.GeneratorType):
+                self.spawn(result)
+
+    def __dispatch_timed(self, dispatch, message):
+        dispatch.restart()
+        for callback, histogram in zip(dispatch.callbacks, dispatch.histograms):
+            start = time.time()
+            result = callback(*message)
+            histogram.add_sample(time.time() - start)
+            if isinstance(result, types.GeneratorType):
+                self.spawn(result)
+
+    def call_soon(self, func, *args):
+        """Call `func` with `args` in the next iteration of the loop.
+
+        This is the only method which is safe to call from other
+        threads.
+
+        """
+        irc = self.__capture_irc()
+        with self.__pending_calls_lock:
+            was_empty = not self.__pending_calls
+            self.__pending_calls.append((func, args, irc))
+        if was_empty:
+            try:
+                os.write(self.__wakeup_wpipe, b"\0")
+            except OSError, e:
+                # The pipe is full, so the loop will wake up anyways.
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def call_later(self, delay, func, *args):
+        """Call `func` with `args` after `delay` seconds.
+
+        Return a Timer which can be cancelled.
+
+        """
+        timer = Timer(time.time() + delay, func, args, self.__capture_irc())
+        heapq.heappush(self.__timers, (timer.when, next(self.__timer_seq), timer))
+        return timer
+
+    def add_reader(self, fileobj, callback):
+        """Call `callback` whenever `fileobj` is readable."""
+        fd = _fileno(fileobj)
+        if fd in self.__readers:
+            raise Error("file descriptor is already watched for reading", fd)
+        self.__readers[fd] = callback
+
+    def remove_reader(self, fileobj):
+        self.__readers.pop(_fileno(fileobj), None)
+
+    def add_writer(self, fileobj, callback):
+        """Call `callback` whenever `fileobj` is writable."""
+        fd = _fileno(fileobj)
+        if fd in self.__writers:
+            raise Error("file descriptor is already watched for writing", fd)
+        self.__writers[fd] = callback
+
+    def remove_writer(self, fileobj):
+        self.__writers.pop(_fileno(fileobj), None)
+
+    def spawn(self, coroutine, errback=None):
+        """Run a generator-based coroutine in the loop.
+
+        The coroutine is resumed after whatever it yields: None yields
+        control to the loop for one iteration, a number sleeps that
+        many seconds, a file object (or descriptor) waits until it is
+        readable, a (file object, timeout) tuple waits until the file
+        is readable or the timeout expires, whichever comes first, and
+        a Future waits until it is done.
+
+        If the coroutine raises an exception, `errback` is called with
+        the exception. Without errback, the exception propagates from
+        the loop.
+
+        """
+        self.__step(coroutine, errback, self.__capture_irc())
+
+    def __step(self, coroutine, errback, irc):
+        try:
+            wait = self.call_with_irc(irc, next, coroutine)
+        except StopIteration:
+            return
+        except Exception, e:
+            if errback is None:
+                raise
+            self.call_with_irc(irc, errback, e)
+            return
+
+        if wait is None:
+            self.call_soon(self.__step, coroutine, errback, irc)
+        elif isinstance(wait, (int, long, float)):
+            self.call_later(wait, self.__step, coroutine, errback, irc)
+        elif isinstance(wait, Future):
+            wait.add_done_callback(lambda future: self.__step(coroutine, errback, irc))
+        elif isinstance(wait, tuple):
+            fileobj, timeout = wait
+            def resume():
+                self.remove_reader(fileobj)
+                timer.cancel()
+                self.__step(coroutine, errback, irc)
+            timer = self.call_later(timeout, resume)
+            self.add_reader(fileobj, resume)
+        else:
+            def readable():
+                self.remove_reader(wait)
+                self.__step(coroutine, errback, irc)
+            self.add_reader(wait, readable)
+
+    def __wakeup(self):
+        try:
+            while os.read(self.__wakeup_rpipe, 4096):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def __run_once(self):
+        timeout = None
+        if self.__pending_calls:
+            timeout = 0
+        elif self.__timers:
+            timeout = max(0, self.__timers[0][0] - time.time())
+
+        try:
+            rs, ws, _ = select.select(self.__readers.keys(),
+                                      self.__writers.keys(), [], timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+
+        for fd in rs:
+            # Callbacks might remove other callbacks.
+            callback = self.__readers.get(fd)
+            if callback is not None:
+                callback()
+
+        for fd in ws:
+            callback = self.__writers.get(fd)
+            if callback is not None:
+                callback()
+
+        now = time.time()
+        while self.__timers and self.__timers[0][0] <= now:
+            _, _, timer = heapq.heappop(self.__timers)
+            if not timer.cancelled:
+                self.call_with_irc(timer.irc, timer.func, *timer.args)
+
+        with self.__pending_calls_lock:
+            pending_calls = self.__pending_calls
+            self.__pending_calls = collections.deque()
+        for func, args, irc in pending_calls:
+            self.call_with_irc(irc, func, *args)
+
+    def __irc_watch_writable(self, irc):
+        if irc.is_connected and irc not in self.__irc_writers_added:
+            self.add_writer(irc, lambda: self.__irc_writable(irc))
+            self.__irc_writers_added.add(irc)
+
+    def __irc_unwatch_writable(self, irc):
+        self.remove_writer(irc)
+        self.__irc_writers_added.discard(irc)
+
+    def __irc_writable(self, irc):
+        try:
+            irc.flush()
+        except socket.error, e:
+            if not self.__reconnect:
+                raise
+            self.__connection_lost(irc, e)
+            return
+        delay = irc.send_delay()
+        if delay != 0:
+            self.__irc_unwatch_writable(irc)
+        if delay:
+            # Rate limited.
+            self.call_later(delay, self.__irc_watch_writable, irc)
+
+    def __irc_readable(self, irc):
+        # Read socket buffer, parse messages and handle them. Errors
+        # from callbacks are not connection errors, so the messages
+        # are iterated by hand.
+        try:
+            messages = irc.recv()
+        except (Error, socket.error), e:
+            if not self.__reconnect:
+                raise
+            self.__connection_lost(irc, e)
+            return
+        while irc.is_connected:
+            try:
+                message = next(messages)
+            except StopIteration:
+                break
+            except Error, e:
+                if not self.__reconnect:
+                    raise
+                self.__connection_lost(irc, e)
+                break
+            self.dispatch_message(message, irc)
+
+    def __connect(self, irc):
+        index = self.__server_indices.get(irc, 0)
+        server, port = irc.servers[index % len(irc.servers)]
+        self.__connect_times[irc] = time.time()
+
+        def connected(sock, error):
+            # Might be called already before the Connector is created.
+            self.__connectors.pop(irc, None)
+            is_done[0] = True
+            self.__connected(irc, server, port, sock, error)
+
+        is_done = [False]
+        connector = t2jrbot.net.Connector(self, server, port, connected,
+                                          irc.tls, irc.tls_verify,
+                                          Bot.CONNECT_ATTEMPT_DELAY,
+                                          Bot.CONNECT_TIMEOUT)
+        if not is_done[0]:
+            self.__connectors[irc] = connector
+
+    def __connected(self, irc, server, port, sock, error):
+        if error is not None:
+            if not self.__reconnect:
+                raise error
+            self.log.warning("IRC", "%s: connecting to %s:%d failed: %s"
+                             % (irc.name, server, port, error))
+            # Try the next server next time.
+            self.__server_indices[irc] = self.__server_indices.get(irc, 0) + 1
+            self.__schedule_reconnect(irc)
+            return
+        irc.connect(server, port, sock)
+        self.log.info("IRC", "%s: connected to %s:%d" % (irc.name, server, port))
+        self.add_reader(irc, lambda: self.__irc_readable(irc))
+        self.__irc_watch_writable(irc)
+
+        # Register connection.
+        irc.send_nick(irc.nick)
+        irc.send_user(irc.nick, irc.nick)
+
+    def __disconnect(self, irc):
+        self.remove_reader(irc)
+        self.__irc_unwatch_writable(irc)
+        irc.shutdown()
+        self.__joining.discard(irc)
+
+    def drop_connection(self, reason):
+        """Close the current connection as if it had failed.
+
+        The connection is reconnected like after any other connection
+        error. Without reconnecting, Error is raised instead, which
+        ends run().
+
+        """
+        if not self.__reconnect:
+            raise Error("connection dropped: %s" % reason)
+        self.__connection_lost(self.irc, reason)
+
+    def __connection_lost(self, irc, reason):
+        if irc.is_connected:
+            self.__disconnect(irc)
+        if self.__is_stopping:
+            return
+        self.log.warning("IRC", "%s: connection to %s:%d lost: %s"
+                         % (irc.name, irc.server, irc.port, reason))
+        # Try the next server next time.
+        self.__server_indices[irc] = self.__server_indices.get(irc, 0) + 1
+        self.__schedule_reconnect(irc)
+
+    def __schedule_reconnect(self, irc):
+        failures = self.__connect_failures.get(irc, 0)
+        self.__connect_failures[irc] = failures + 1
+        # Full jitter: a random delay up to the exponential bound.
+        bound = min(Bot.RECONNECT_MAX_DELAY,
+                    Bot.RECONNECT_MIN_DELAY * 2 ** failures)
+        delay = random.uniform(Bot.RECONNECT_MIN_DELAY, bound)
+        self.log.info("IRC", "%s: reconnecting in %.1f s" % (irc.name, delay))
+        self.call_later(delay, self.__connect, irc)
+
+    def run(self, server, port):
+        """Connect all connections and run the loop until stopped.
+
+        The default connection connects to `server` and `port` first
+        and then to its other servers, if any. Lost connections are
+        connected again, unless reconnecting is disabled.
+
+        """
+        if (server, port) not in self.__default_irc.servers:
+            self.__default_irc.servers.insert(0, (server, port))
+        connections = self.__connections.values()
+        try:
+            for irc in connections:
+                self.__connect(irc)
+
+            while not self.__is_stopping:
+                self.__run_once()
 
-                    for callback_index in sorted(callback_indices):
-                        callback = self.__irc_callbacks[callback_index]
-                        callback(prefix, command, params)
+            # Send the rest, e.g. QUIT, before closing the connections.
+            for irc in connections:
+                if irc.is_connected:
+                    irc.drain()
         finally:
-            self.irc.shutdown()
+            for connector in self.__connectors.values():
+                connector.cancel()
+            self.__connectors.clear()
+            for irc in connections:
+                if irc.is_connected:
+                    self.__disconnect(irc)
 
     def __enter__(self):
         return self
@@ -228,7 +1480,11 @@ class Bot(object):
                 # gave it the chance we had promised but it blew it.
                 continue
 
-        self.irc.close()
+        for irc in self.__connections.values():
+            irc.close()
+        self.log.close()
+        os.close(self.__wakeup_rpipe)
+        os.close(self.__wakeup_wpipe)
 
         return False # Do not suppress the exception which caused the
                      # exit.
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+# t2jrbot - simple but elegant IRC bot
+# Copyright © 2014 Tuomas Räsänen <tuomasjjrasanen@tjjr.fi>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import datetime
+import json
+import sys
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+
+_LEVEL_NAMES = dict([(v, k) for k, v in LEVELS.items()])
+
+class Log(object):
+    """Levelled log written by a background thread.
+
+    Callers only append records to a bounded queue without taking any
+    locks. The writer thread wakes up every FLUSH_INTERVAL seconds to
+    format and write them. If the queue is full, records are dropped
+    rather than blocking the caller, and the number of dropped records
+    is logged later.
+
+    IRC traffic is logged at INFO level with rx() and tx(). Messages of
+    commands in `suppress` are not logged at all, and only every n-th
+    received message of commands in `sample`, which maps commands to
+    n, is logged.
+
+    """
+
+    MAX_QUEUE_SIZE = 10000
+    FLUSH_INTERVAL = 0.1
+
+    def __init__(self, stream=None, level=INFO, json_lines=False,
+                 suppress=(), sample=None):
+        if stream is None:
+            stream = sys.stdout
+        self.__stream = stream
+        self.level = level
+        self.__json_lines = json_lines
+        self.__suppress = frozenset(suppress)
+        self.__sample = dict(sample or {})
+        self.__sample_counts = dict.fromkeys(self.__sample, 0)
+        self.__dropped = 0
+
+        # Formatted timestamp of the current second.
+        self.__timestamp_second = None
+        self.__timestamp_prefix = None
+
+        # Appending to and popping from a deque is atomic.
+        self.__queue = collections.deque()
+        self.__writer = None
+        self.__is_closing = threading.Event()
+
+    def __start(self):
+        self.__is_closing.clear()
+        self.__writer = threading.Thread(target=self.__write_records)
+        self.__writer.daemon = True
+        self.__writer.start()
+
+    def close(self):
+        """Write all queued records and stop the writer."""
+        if self.__writer is not None:
+            self.__is_closing.set()
+            self.__writer.join()
+            self.__writer = None
+
+    def write(self, level, name, msg):
+        if level < self.level:
+            return
+        if self.__writer is None:
+            self.__start()
+        if len(self.__queue) >= Log.MAX_QUEUE_SIZE:
+            self.__dropped += 1
+            return
+        self.__queue.append((time.time(), level, name, msg))
+
+    def debug(self, name, msg):
+        self.write(DEBUG, name, msg)
+
+    def info(self, name, msg):
+        self.write(INFO, name, msg)
+
+    def warning(self, name, msg):
+        self.write(WARNING, name, msg)
+
+    def error(self, name, msg):
+        self.write(ERROR, name, msg)
+
+    def rx(self, command, line, network=None):
+        if self.level > INFO or command in self.__suppress:
+            return
+        try:
+            n = self.__sample[command]
+        except KeyError:
+            pass
+        else:
+            count = self.__sample_counts[command]
+            self.__sample_counts[command] = count + 1
+            if count % n:
+                return
+        self.write(INFO, "<=IRC" if network is None else "<=IRC/%s" % network, line)
+
+    def tx(self, command, line, network=None):
+        if self.level > INFO or command in self.__suppress:
+            return
+        self.write(INFO, "=>IRC" if network is None else "=>IRC/%s" % network, line)
+
+    def __format_timestamp(self, timestamp):
+        second = int(timestamp)
+        if second != self.__timestamp_second:
+            dt = datetime.datetime.utcfromtimestamp(second)
+            self.__timestamp_second = second
+            self.__timestamp_prefix = dt.strftime("%Y-%m-%dT%H:%M:%S")
+        return "%s.%06d" % (self.__timestamp_prefix,
+                            int((timestamp - second) * 1000000))
+
+    def __format(self, timestamp, level, name, msg):
+        timestamp = self.__format_timestamp(timestamp)
+        if self.__json_lines:
+            return json.dumps({"time": timestamp,
+                               "level": _LEVEL_NAMES.get(level, level),
+                               "name": name,
+                               "msg": (msg if isinstance(msg, unicode)
+                                       else msg.decode("utf-8", "replace"))})
+        if level == INFO:
+            return "%s %s %s" % (timestamp, name, msg)
+        return "%s %s %s %s" % (timestamp, _LEVEL_NAMES.get(level, level).upper(),
+                                name, msg)
+
+    def __write_records(self):
+        while True:
+            is_closing = self.__is_closing.wait(Log.FLUSH_INTERVAL)
+            lines = []
+            while True:
+                try:
+                    record = self.__queue.popleft()
+                except IndexError:
+                    break
+                lines.append(self.__format(*record))
+            if self.__dropped:
+                dropped, self.__dropped = self.__dropped, 0
+                lines.append(self.__format(time.time(), WARNING, "log",
+                                           "dropped %d records" % dropped))
+            if lines:
+                # Write everything with a single call.
+                self.__stream.write("%s\n" % "\n".join(lines))
+                self.__stream.flush()
+            if is_closing:
+                break
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+# t2jrbot - simple but elegant IRC bot
+# Copyright © 2014 Tuomas Räsänen <tuomasjjrasanen@tjjr.fi>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import errno
+import os
+import socket
+
+class Error(Exception):
+    pass
+
+def _interleave(addrinfos):
+    # RFC 8305 section 4: alternate address families, starting with
+    # the family of the first address.
+    by_family = collections.OrderedDict()
+    for addrinfo in addrinfos:
+        by_family.setdefault(addrinfo[0], []).append(addrinfo)
+    queues = [collections.deque(infos) for infos in by_family.values()]
+    result = []
+    while queues:
+        for queue in list(queues):
+            result.append(queue.popleft())
+            if not queue:
+                queues.remove(queue)
+    return result
+
+class Connector(object):
+    """Connect to a host in the bot loop, racing all its addresses.
+
+    The addresses are tried in the order of RFC 8305 ("Happy
+    Eyeballs"): IPv6 and IPv4 interleaved, a new attempt started every
+    `attempt_delay` seconds or as soon as the previous one fails, and
+    the first attempt to succeed wins. Each attempt gives up after
+    `attempt_timeout` seconds. With `tls`, the connection is wrapped in
+    TLS after connecting, verifying the certificate if `tls_verify` is
+    True.
+
+    When done, `callback` is called with a connected non-blocking
+    socket and None, or with None and an Error.
+
+    """
+
+    def __init__(self, bot, host, port, callback, tls=False, tls_verify=True,
+                 attempt_delay=0.25, attempt_timeout=10):
+        self.__bot = bot
+        self.__host = host
+        self.__callback = callback
+        self.__tls = tls
+        self.__tls_verify = tls_verify
+        self.__attempt_delay = attempt_delay
+        self.__attempt_timeout = attempt_timeout
+        self.__attempts = {} # Maps sockets to (address, timer) pairs.
+        self.__next_timer = None
+        self.__errors = []
+        self.__is_done = False
+
+        try:
+            # Resolving blocks, but usually hits a local cache.
+            addrinfos = socket.getaddrinfo(host, port, socket.AF_UNSPEC,
+                                           socket.SOCK_STREAM)
+        except socket.gaierror, e:
+            self.__finish(None, Error("cannot resolve %s: %s" % (host, e.strerror)))
+            return
+        self.__addrinfos = collections.deque(_interleave(addrinfos))
+        self.__start_attempt()
+
+    def cancel(self):
+        """Abort all attempts without calling the callback."""
+        self.__is_done = True
+        self.__stop_attempts()
+
+    def __finish(self, sock, error):
+        if self.__is_done:
+            return
+        self.__is_done = True
+        self.__stop_attempts()
+        self.__callback(sock, error)
+
+    def __stop_attempts(self):
+        if self.__next_timer is not None:
+            self.__next_timer.cancel()
+            self.__next_timer = None
+        for sock in list(self.__attempts):
+            self.__end_attempt(sock)
+            sock.close()
+
+    def __end_attempt(self, sock):
+        address, timer = self.__attempts.pop(sock)
+        timer.cancel()
+        self.__bot.remove_writer(sock)
+        self.__bot.remove_reader(sock)
+        return address
+
+    def __start_attempt(self):
+        self.__next_timer = None
+        while self.__addrinfos:
+            family, socktype, proto, _, address = self.__addrinfos.popleft()
+            try:
+                sock = socket.socket(family, socktype, proto)
+            except socket.error, e:
+                # E.g. no IPv6 support on this host.
+                self.__errors.append("%s: %s" % (address[0], e))
+                continue
+            sock.setblocking(False)
+            err = sock.connect_ex(address)
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                self.__errors.append("%s: %s" % (address[0], os.strerror(err)))
+                sock.close()
+                continue
+            timer = self.__bot.call_later(self.__attempt_timeout,
+                                          self.__fail_attempt, sock, "timed out")
+            self.__attempts[sock] = (address, timer)
+            self.__bot.add_writer(sock, lambda: self.__writable(sock))
+            if self.__addrinfos:
+                self.__next_timer = self.__bot.call_later(self.__attempt_delay,
+                                                          self.__start_attempt)
+            return
+        self.__check_exhausted()
+
+    def __check_exhausted(self):
+        if not self.__attempts and not self.__addrinfos:
+            self.__finish(None, Error("cannot connect to %s: %s"
+                                      % (self.__host, ", ".join(self.__errors))))
+
+    def __fail_attempt(self, sock, reason):
+        address = self.__end_attempt(sock)
+        sock.close()
+        self.__errors.append("%s: %s" % (address[0], reason))
+        was_waiting = self.__next_timer is not None
+        if was_waiting:
+            self.__next_timer.cancel()
+            self.__next_timer = None
+        if self.__addrinfos and (was_waiting or not self.__attempts):
+            # Do not wait for the delay, start the next attempt now.
+            self.__start_attempt()
+        else:
+            self.__check_exhausted()
+
+    def __writable(self, sock):
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self.__fail_attempt(sock, os.strerror(err))
+            return
+        if not self.__tls:
+            self.__end_attempt(sock)
+            self.__finish(sock, None)
+            return
+
+        # Stop racing, the handshake continues on this socket alone.
+        self.__bot.remove_writer(sock)
+        if self.__next_timer is not None:
+            self.__next_timer.cancel()
+            self.__next_timer = None
+        for other in [s for s in self.__attempts if s is not sock]:
+            self.__end_attempt(other)
+            other.close()
+
+        # Imported only when needed, most servers are plain text.
+        import ssl
+        context = ssl.create_default_context()
+        if not self.__tls_verify:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        address, timer = self.__attempts.pop(sock)
+        try:
+            tls_sock = context.wrap_socket(sock, server_hostname=self.__host,
+                                           do_handshake_on_connect=False)
+        except (ssl.SSLError, socket.error), e:
+            self.__attempts[sock] = (address, timer)
+            self.__fail_attempt(sock, e)
+            return
+        self.__attempts[tls_sock] = (address, timer)
+        self.__handshake(tls_sock)
+
+    def __handshake(self, sock):
+        import ssl
+        self.__bot.remove_reader(sock)
+        self.__bot.remove_writer(sock)
+        try:
+            sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self.__bot.add_reader(sock, lambda: self.__handshake(sock))
+            return
+        except ssl.SSLWantWriteError:
+            self.__bot.add_writer(sock, lambda: self.__handshake(sock))
+            return
+        except (ssl.SSLError, socket.error), e:
+            self.__fail_attempt(sock, e)
+            return
+        self.__end_attempt(sock)
+        self.__finish(sock, None)
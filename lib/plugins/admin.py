@@ -20,19 +20,83 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import errno
+import os
+import re
+
 import t2jrbot.conf
 
+DEPENDENCIES = ["t2jrbot.plugins.command"]
+
+def _is_glob(mask):
+    return "*" in mask or "?" in mask
+
+def _compile_masks(masks):
+    """Return a function matching strings against any of the hostmask globs."""
+    if not masks:
+        return lambda s: False
+    patterns = []
+    for mask in masks:
+        pattern = "".join([{"*": ".*", "?": "."}.get(c, re.escape(c))
+                           for c in mask])
+        patterns.append(pattern)
+    regex = re.compile(r"(?:%s)\Z" % "|".join(patterns), re.DOTALL)
+    return lambda s: regex.match(s) is not None
+
+def require_admins(bot, commands):
+    """Keep `commands` admin-only even without the admin plugin.
+
+    While the admin plugin is loaded, its own hook decides who may run
+    the commands. Otherwise they are denied from everyone. Call this
+    while loading the plugin which registers the commands.
+
+    """
+    def check_admin_plugin(nick, host, channel, command, argstr):
+        if __name__ in bot.plugins:
+            return True
+        bot.irc.send_privmsg(channel,
+                             "%s: only admins are allowed to %s" % (nick, command))
+        return False
+
+    command_plugin = bot.plugins["t2jrbot.plugins.command"]
+    for command in commands:
+        command_plugin.add_pre_eval_hook(check_admin_plugin, command=command,
+                                         priority=-100)
+
 class _AdminPlugin(object):
 
+    _ADMINS_FILE = os.path.expanduser("~/.t2jrbot/plugins/admin/admins")
+
     def __init__(self, bot, admins, command_whitelist):
         self.__bot = bot
 
-        self.__admins = set([self.__parse_admin_arg(a) for a in admins])
+        self.__conf_admins = [] # Admin hostmasks from the configuration.
+        for admin in admins:
+            admin = self.__parse_admin_arg(admin)
+            if admin not in self.__conf_admins:
+                self.__conf_admins.append(admin)
+
+        # Changes made at runtime are applied on top of the
+        # configuration, so that removing an admin from the
+        # configuration takes effect even after admins have been
+        # added at runtime.
+        self.__added_admins = []
+        self.__removed_admins = []
+        if os.path.exists(_AdminPlugin._ADMINS_FILE):
+            self.__load_admin_changes()
+
+        self.__admins = [] # Admin hostmasks in the order they were added.
+        self.__exact_admins = set()
+        self.__match_admin_mask = None
+        self.__compile_admins()
+
         self.__command_whitelist = set(command_whitelist)
 
         command_plugin = self.__bot.plugins["t2jrbot.plugins.command"]
 
-        command_plugin.add_pre_eval_hook(self.__check_auth)
+        # Authorization is cheap and decides whether other hooks
+        # are worth running at all.
+        command_plugin.add_pre_eval_hook(self.__check_auth, priority=-100)
 
         command_plugin.register_command("!admin_list",
                                         self.__command_admin_list,
@@ -40,23 +104,87 @@ class _AdminPlugin(object):
 
         command_plugin.register_command("!admin_add",
                                         self.__command_admin_add,
-                                        "Add a bot admin. "
+                                        "Add a bot admin, kept over restarts "
+                                        "unless removed with !admin_remove. "
+                                        "NICK, USER and HOST "
+                                        "can contain wildcards * and ?. "
                                         "Usage: !admin_add NICK!USER@HOST, "
-                                        "e.g. !admin_add fanatic!fan.atic@example.org")
+                                        "e.g. !admin_add fanatic!fan.atic@example.org "
+                                        "or !admin_add *!*@staff.example.org")
 
         command_plugin.register_command("!admin_remove",
                                         self.__command_admin_remove,
-                                        "Remove a bot admin. "
+                                        "Remove a bot admin, also one listed "
+                                        "in the configuration. "
                                         "Usage: !admin_remove NICK!USER@HOST, "
                                         "e.g. !admin_remove fanatic!fan.atic@example.org")
 
     def release(self):
         pass
 
+    def __load_admin_changes(self):
+        # Each line is "+NICK!USER@HOST" or "-NICK!USER@HOST".
+        with open(_AdminPlugin._ADMINS_FILE) as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith("+"):
+                    self.__added_admins.append(self.__parse_admin_arg(line[1:]))
+                elif line.startswith("-"):
+                    self.__removed_admins.append(self.__parse_admin_arg(line[1:]))
+
+        for admin in self.__added_admins:
+            self.__bot.log.warning("ADMIN", "%s is an admin, added at runtime "
+                                   "but not in the configuration" % admin)
+        for admin in self.__removed_admins:
+            self.__bot.log.warning("ADMIN", "%s is not an admin, removed at "
+                                   "runtime but in the configuration" % admin)
+
+    def __compile_admins(self):
+        self.__admins = [a for a in self.__conf_admins
+                         if a not in self.__removed_admins]
+        self.__admins.extend([a for a in self.__added_admins
+                              if a not in self.__admins])
+
+        # Hostmasks are matched case-insensitively, like IRC servers
+        # do. Exact hostmasks, the common case, are looked up from a
+        # set, globs are combined into a single regular expression.
+        admins = [admin.lower() for admin in self.__admins]
+        self.__exact_admins = set([a for a in admins if not _is_glob(a)])
+        self.__match_admin_mask = _compile_masks([a for a in admins if _is_glob(a)])
+
+    def __save_admins(self):
+        dirpath = os.path.dirname(_AdminPlugin._ADMINS_FILE)
+        try:
+            os.makedirs(dirpath)
+        except OSError, e:
+            # mkdir -p behavior
+            if e.errno != errno.EEXIST:
+                raise e
+        # Write a new file and rename it over the old one, so that a
+        # crash never leaves a partially written admin list behind.
+        tmp_path = "%s.tmp" % _AdminPlugin._ADMINS_FILE
+        old_umask = os.umask(077)
+        try:
+            with open(tmp_path, "w") as f:
+                for admin in self.__added_admins:
+                    f.write("+%s\n" % admin)
+                for admin in self.__removed_admins:
+                    f.write("-%s\n" % admin)
+                f.flush()
+                os.fsync(f.fileno())
+        finally:
+            os.umask(old_umask)
+        os.rename(tmp_path, _AdminPlugin._ADMINS_FILE)
+
+    def __is_admin(self, nick, host):
+        hostmask = ("%s!%s" % (nick, host)).lower()
+        return (hostmask in self.__exact_admins
+                or self.__match_admin_mask(hostmask))
+
     def __check_auth(self, nick, host, channel, command, argstr):
         if ((command in self.__command_whitelist)
             or
-            ((nick, host) in self.__admins)):
+            self.__is_admin(nick, host)):
             return True
 
         self.__bot.irc.send_privmsg(channel,
@@ -65,16 +193,29 @@ class _AdminPlugin(object):
         return False
 
     def __command_admin_list(self, nick, host, channel, this_command, argstr):
-        admins = ["%s!%s" % (nick, host) for nick, host in self.__admins]
-        self.__bot.irc.send_privmsg(channel, "%s: %s" % (nick, " ".join(admins)))
+        self.__bot.irc.send_privmsg(channel, "%s: %s" % (nick, " ".join(self.__admins)))
 
     def __command_admin_add(self, nick, host, channel, this_command, argstr):
-        admin_nick, admin_host = self.__parse_admin_arg(argstr)
-        self.__admins.add((admin_nick, admin_host))
+        admin = self.__parse_admin_arg(argstr)
+        if admin in self.__admins:
+            return
+        if admin in self.__removed_admins:
+            self.__removed_admins.remove(admin)
+        if admin not in self.__conf_admins:
+            self.__added_admins.append(admin)
+        self.__compile_admins()
+        self.__save_admins()
 
     def __command_admin_remove(self, nick, host, channel, this_command, argstr):
-        admin_nick, admin_host = self.__parse_admin_arg(argstr)
-        self.__admins.discard((admin_nick, admin_host))
+        admin = self.__parse_admin_arg(argstr)
+        if admin not in self.__admins:
+            return
+        if admin in self.__added_admins:
+            self.__added_admins.remove(admin)
+        if admin in self.__conf_admins:
+            self.__removed_admins.append(admin)
+        self.__compile_admins()
+        self.__save_admins()
 
     def __parse_admin_arg(self, admin):
         admin_nick, sep, admin_host = admin.partition("!")
@@ -83,7 +224,7 @@ class _AdminPlugin(object):
         if not admin_nick or not sep or not admin_host:
             raise ValueError("malformed admin identifier, should "
                              "be of form 'nick!user@example.org'")
-        return admin_nick, admin_host
+        return "%s!%s" % (admin_nick, admin_host)
 
 def check_conf(conf):
     t2jrbot.conf.check_keys(conf, ["admins", "command_whitelist"])
@@ -21,34 +21,191 @@ from __future__ import division
 from __future__ import print_function
 
 import t2jrbot.conf
+import t2jrbot.core
+
+# Replies to JOINs which might succeed later.
+_RETRYABLE_JOIN_ERRORS = (
+    "437", # ERR_UNAVAILRESOURCE
+    "471", # ERR_CHANNELISFULL
+    "473", # ERR_INVITEONLYCHAN
+    "474", # ERR_BANNEDFROMCHAN
+    "475", # ERR_BADCHANNELKEY
+)
+
+def pack_joins(channels, keys, max_len=t2jrbot.core.IRC.MAX_MSG_LEN):
+    """Return JOIN messages joining `channels` in as few lines as possible.
+
+    `keys` maps channels to their keys. Keys are matched to channels by
+    position, so channels with keys come first on each line.
+
+    """
+    channels = ([c for c in channels if c in keys]
+                + [c for c in channels if c not in keys])
+    msgs = []
+    line_channels = []
+    line_keys = []
+    length = len("JOIN ")
+    for channel in channels:
+        key = keys.get(channel)
+        # A comma or a space before the channel and its key.
+        extra = len(channel) + (1 if line_channels else 0)
+        if key is not None:
+            extra += len(key) + 1
+        if line_channels and length + extra > max_len:
+            msgs.append(_format_join(line_channels, line_keys))
+            line_channels, line_keys = [], []
+            length = len("JOIN ")
+            extra = len(channel) + (len(key) + 1 if key is not None else 0)
+        line_channels.append(channel)
+        if key is not None:
+            line_keys.append(key)
+        length += extra
+    if line_channels:
+        msgs.append(_format_join(line_channels, line_keys))
+    return msgs
+
+def _format_join(channels, keys):
+    if keys:
+        return "JOIN %s %s" % (",".join(channels), ",".join(keys))
+    return "JOIN %s" % ",".join(channels)
+
+class _Network(object):
+
+    def __init__(self):
+        # Lowercased names of channels joined but not yet confirmed.
+        self.pending = set()
+        self.failed = set() # Channels to try again later.
+        self.timers = []
+
+    def cancel_timers(self):
+        for timer in self.timers:
+            timer.cancel()
+        self.timers = []
 
 class _AutojoinPlugin(object):
 
-    def __init__(self, bot, channel):
+    def __init__(self, bot, channels, keys, join_interval, retry_interval):
         self.__bot = bot
-        self.__channel = channel
+        self.__channels = channels
+        # Servers might echo channel names in another case.
+        self.__channel_names = dict([(c.lower(), c) for c in channels])
+        self.__keys = keys
+        self.__join_interval = join_interval
+        self.__retry_interval = retry_interval
+        self.__networks = {} # Maps connection names to _Network objects.
 
         self.__bot.add_irc_callback(self.__irc_001, command="001")
+        self.__bot.add_irc_callback(self.__irc_join, command="JOIN")
+        for command in _RETRYABLE_JOIN_ERRORS:
+            self.__bot.add_irc_callback(self.__irc_join_error, command=command)
 
     def release(self):
-        pass
+        for network in self.__networks.values():
+            network.cancel_timers()
+
+    def __get_network(self):
+        return self.__networks.setdefault(self.__bot.irc.name, _Network())
+
+    def __join(self, network, channels):
+        # Send one line at a time, servers limit the rate of joins
+        # more strictly than the rate of messages.
+        network.pending.update([c.lower() for c in channels])
+        msgs = pack_joins([c for c in self.__channels if c in channels],
+                          self.__keys)
+        for i, msg in enumerate(msgs):
+            if i == 0:
+                self.__bot.irc.send(msg)
+            else:
+                timer = self.__bot.call_later(i * self.__join_interval,
+                                              self.__bot.irc.send, msg)
+                network.timers.append(timer)
 
     def __irc_001(self, prefix, this_command, params):
         # Update the nick after successful connection because
         # the server might have truncated or otherwise modified
         # the nick we requested.
         self.__bot.nick = params[0]
-        self.__bot.irc.send_join(self.__channel)
+
+        # Start afresh after reconnecting.
+        network = self.__get_network()
+        network.cancel_timers()
+        network.pending.clear()
+        network.failed.clear()
+        self.__join(network, set(self.__channels))
+
+    def __irc_join(self, prefix, this_command, params):
+        if self.__bot.current_message.nick != self.__bot.nick:
+            return
+        network = self.__get_network()
+        for channel in params[0].split(","):
+            network.pending.discard(channel.lower())
+            network.failed.discard(self.__channel_names.get(channel.lower()))
+
+    def __irc_join_error(self, prefix, this_command, params):
+        # ":server 474 nick #channel :Cannot join channel (+b)"
+        if len(params) < 2:
+            return
+        network = self.__get_network()
+        channel = params[1].lower()
+        if channel not in network.pending:
+            return
+        network.pending.discard(channel)
+        if not network.failed:
+            timer = self.__bot.call_later(self.__retry_interval, self.__retry)
+            network.timers.append(timer)
+        network.failed.add(self.__channel_names[channel])
+
+    def __retry(self):
+        network = self.__get_network()
+        channels = network.failed
+        network.failed = set()
+        network.timers = [t for t in network.timers if not t.cancelled]
+        if channels:
+            self.__join(network, channels)
+
+def _parse_channel(channel):
+    # "#channel" or "#channel key"
+    name, _, key = channel.strip().partition(" ")
+    return name, key.strip() or None
 
 def check_conf(conf):
-    t2jrbot.conf.check_keys(conf, ["channel"])
+    t2jrbot.conf.check_keys(conf, ["channel", "channels", "join_interval",
+                                   "retry_interval"])
 
     t2jrbot.conf.check_value(conf, "channel",
-                             lambda v: isinstance(v, str))
+                             lambda v: isinstance(v, str),
+                             required=False)
+
+    t2jrbot.conf.check_value(conf, "channels",
+                             lambda vs: (isinstance(vs, list)
+                                         and all([isinstance(v, str) and v.strip()
+                                                  for v in vs])),
+                             required=False)
+
+    t2jrbot.conf.check_value(conf, "join_interval",
+                             lambda v: isinstance(v, (int, float)) and v >= 0,
+                             required=False)
+
+    t2jrbot.conf.check_value(conf, "retry_interval",
+                             lambda v: isinstance(v, (int, float)) and v > 0,
+                             required=False)
 
 def load(bot, conf):
     check_conf(conf)
 
-    channel = conf["channel"]
+    channels = []
+    keys = {}
+    entries = conf.get("channels", [])
+    if "channel" in conf:
+        entries = [conf["channel"]] + entries
+    for entry in entries:
+        channel, key = _parse_channel(entry)
+        if channel in channels:
+            continue
+        channels.append(channel)
+        if key is not None:
+            keys[channel] = key
+    join_interval = conf.get("join_interval", 2)
+    retry_interval = conf.get("retry_interval", 60)
 
-    return _AutojoinPlugin(bot, channel)
+    return _AutojoinPlugin(bot, channels, keys, join_interval, retry_interval)
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+
+# Channels plugin for t2jrbot.
+# Copyright © 2014 Tuomas Räsänen <tuomasjjrasanen@tjjr.fi>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import re
+import string
+import sys
+
+import t2jrbot.conf
+
+DEPENDENCIES = ["t2jrbot.plugins.command"]
+
+_PREFIX_PATTERN = re.compile(r"^\(([^)]*)\)(.*)$")
+
+# Translation tables of ISUPPORT CASEMAPPING values. In the RFC 1459
+# casemapping, the default, []\~ are uppercase forms of {}|^.
+_CASEMAPPINGS = {
+    "ascii": string.maketrans(string.ascii_uppercase,
+                              string.ascii_lowercase),
+    "rfc1459": string.maketrans(string.ascii_uppercase + "[]\\~",
+                                string.ascii_lowercase + "{}|^"),
+    "strict-rfc1459": string.maketrans(string.ascii_uppercase + "[]\\",
+                                       string.ascii_lowercase + "{}|"),
+}
+
+class _Network(object):
+
+    def __init__(self):
+        self.casemapping = _CASEMAPPINGS["rfc1459"]
+        # Maps casefolded channel names to dicts mapping casefolded
+        # nicks to member mode bits.
+        self.channels = {}
+        # Maps casefolded nicks of members to the nicks as they were
+        # last seen, e.g. "nick" to "Nick". Most nicks are written in
+        # lowercase and are not stored here.
+        self.nicks = {}
+        # Member dicts of channels whose NAMES reply is being received.
+        self.pending_names = {}
+        # Member modes and their nick prefixes, from ISUPPORT PREFIX.
+        self.set_prefix_modes("ov", "@+")
+        # Channel modes which take a parameter when set, or also when
+        # unset, from ISUPPORT CHANMODES.
+        self.param_modes = set("beIkl")
+        self.unset_param_modes = set("beIk")
+
+    def fold(self, name):
+        """Return `name` in lowercase according to the casemapping."""
+        return name.translate(self.casemapping)
+
+    def add_nick(self, nick):
+        """Remember how `nick` is written and return its interned key."""
+        key = intern(self.fold(nick))
+        if nick == key:
+            self.nicks.pop(key, None)
+        else:
+            self.nicks[key] = intern(nick)
+        return key
+
+    def forget_nicks(self, keys):
+        """Forget how nicks are written unless they are still members."""
+        for key in keys:
+            if key not in self.nicks:
+                continue
+            for members in self.channels.values():
+                if key in members:
+                    break
+            else:
+                self.nicks.pop(key, None)
+
+    def set_prefix_modes(self, modes, prefixes):
+        self.mode_bits = dict([(m, 1 << i) for i, m in enumerate(modes)])
+        self.prefix_bits = dict([(p, 1 << i) for i, p in enumerate(prefixes)])
+        self.prefixes = prefixes
+
+class _ChannelsPlugin(object):
+    """Track members of joined channels and their modes.
+
+    Each channel maps nicks to an integer of mode bits. Nicks and
+    channel names are compared in lowercase, according to the
+    casemapping of the network, and nicks are shown as they were last
+    written. Nick strings are interned, so a nick is stored once
+    however many channels it is in.
+
+    """
+
+    def __init__(self, bot):
+        self.__bot = bot
+        self.__networks = {} # Maps connection names to _Network objects.
+
+        for command, callback in (("005", self.__irc_005),
+                                  ("353", self.__irc_353),
+                                  ("366", self.__irc_366),
+                                  ("JOIN", self.__irc_join),
+                                  ("PART", self.__irc_part),
+                                  ("KICK", self.__irc_kick),
+                                  ("QUIT", self.__irc_quit),
+                                  ("NICK", self.__irc_nick),
+                                  ("MODE", self.__irc_mode)):
+            self.__bot.add_irc_callback(callback, command=command)
+        self.__bot.add_connect_callback(self.__connected)
+
+        command_plugin = self.__bot.plugins["t2jrbot.plugins.command"]
+        command_plugin.register_command("!channels", self.__command_channels,
+                                        "Show tracked channels, members and "
+                                        "memory used. Usage: !channels")
+
+    def release(self):
+        pass
+
+    def __get_network(self):
+        name = self.__bot.irc.name
+        try:
+            return self.__networks[name]
+        except KeyError:
+            network = _Network()
+            self.__networks[name] = network
+            return network
+
+    def __connected(self):
+        # Channels are joined again after reconnecting, start afresh.
+        self.__networks.pop(self.__bot.irc.name, None)
+
+    def is_member(self, channel, nick):
+        """Return True if `nick` is on `channel` of the current connection."""
+        network = self.__get_network()
+        members = network.channels.get(network.fold(channel))
+        return members is not None and network.fold(nick) in members
+
+    def has_mode(self, channel, nick, mode):
+        """Return True if `nick` has member `mode`, e.g. "o", on `channel`."""
+        network = self.__get_network()
+        members = network.channels.get(network.fold(channel))
+        if members is None:
+            return False
+        return bool(members.get(network.fold(nick), 0)
+                    & network.mode_bits.get(mode, 0))
+
+    def get_members(self, channel):
+        """Return nicks on `channel` of the current connection."""
+        network = self.__get_network()
+        members = network.channels.get(network.fold(channel), ())
+        return [network.nicks.get(key, key) for key in members]
+
+    def get_channels(self):
+        """Return the channels the bot is on in the current connection.
+
+        Channel names are in lowercase.
+
+        """
+        return list(self.__get_network().channels)
+
+    def memory_usage(self):
+        """Return an estimate of bytes used for tracking.
+
+        Strings shared with other parts of the bot are counted too.
+
+        """
+        size = 0
+        nicks = {}
+        for network in self.__networks.values():
+            size += sys.getsizeof(network.channels) + sys.getsizeof(network.nicks)
+            for channel, members in network.channels.items():
+                size += sys.getsizeof(channel) + sys.getsizeof(members)
+            for members in network.channels.values():
+                for key in members:
+                    nicks[id(key)] = key
+            for nick in network.nicks.values():
+                nicks[id(nick)] = nick
+        return size + sum([sys.getsizeof(nick) for nick in nicks.values()])
+
+    def __irc_005(self, prefix, this_command, params):
+        network = self.__get_network()
+        for token in params[1:-1]:
+            key, _, value = token.partition("=")
+            if key == "PREFIX":
+                match = _PREFIX_PATTERN.match(value)
+                if match and len(match.group(1)) == len(match.group(2)):
+                    network.set_prefix_modes(match.group(1), match.group(2))
+            elif key == "CASEMAPPING" and value in _CASEMAPPINGS:
+                # Sent before joining, nothing is tracked yet.
+                network.casemapping = _CASEMAPPINGS[value]
+            elif key == "CHANMODES":
+                groups = (value.split(",") + ["", "", ""])[:3]
+                network.param_modes = set("".join(groups))
+                network.unset_param_modes = set("".join(groups[:2]))
+
+    def __irc_353(self, prefix, this_command, params):
+        # ":server 353 me = #channel :@op +voiced nick"
+        network = self.__get_network()
+        channel = network.fold(params[-2])
+        # Large channels are listed in many replies, collect them
+        # until 366 and only then replace the old member list.
+        members = network.pending_names.setdefault(channel, {})
+        prefixes = network.prefixes
+        prefix_bits = network.prefix_bits
+        for name in params[-1].split():
+            bits = 0
+            i = 0
+            while i < len(name) and name[i] in prefixes:
+                bits |= prefix_bits[name[i]]
+                i += 1
+            # NAMESX/UHNAMES style nick!user@host is reduced to nick.
+            members[network.add_nick(name[i:].partition("!")[0])] = bits
+
+    def __irc_366(self, prefix, this_command, params):
+        network = self.__get_network()
+        channel = network.fold(params[1])
+        members = network.pending_names.pop(channel, None)
+        if members is not None and channel in network.channels:
+            old_members = network.channels[channel]
+            network.channels[channel] = members
+            network.forget_nicks([key for key in old_members if key not in members])
+
+    def __is_me(self, network, nick):
+        return network.fold(nick) == network.fold(self.__bot.nick)
+
+    def __irc_join(self, prefix, this_command, params):
+        network = self.__get_network()
+        nick = self.__bot.current_message.nick
+        channel = network.fold(params[0])
+        if self.__is_me(network, nick):
+            network.channels[channel] = {}
+            return
+        members = network.channels.get(channel)
+        if members is not None:
+            members[network.add_nick(nick)] = 0
+
+    def __remove_member(self, channel, nick):
+        network = self.__get_network()
+        channel = network.fold(channel)
+        if self.__is_me(network, nick):
+            members = network.channels.pop(channel, {})
+            network.pending_names.pop(channel, None)
+            network.forget_nicks(members)
+            return
+        members = network.channels.get(channel)
+        if members is not None:
+            key = network.fold(nick)
+            members.pop(key, None)
+            network.forget_nicks([key])
+
+    def __irc_part(self, prefix, this_command, params):
+        nick = self.__bot.current_message.nick
+        for channel in params[0].split(","):
+            self.__remove_member(channel, nick)
+
+    def __irc_kick(self, prefix, this_command, params):
+        for channel in params[0].split(","):
+            self.__remove_member(channel, params[1])
+
+    def __irc_quit(self, prefix, this_command, params):
+        network = self.__get_network()
+        key = network.fold(self.__bot.current_message.nick)
+        for members in network.channels.values():
+            members.pop(key, None)
+        network.nicks.pop(key, None)
+
+    def __irc_nick(self, prefix, this_command, params):
+        network = self.__get_network()
+        key = network.fold(self.__bot.current_message.nick)
+        new_key = network.fold(params[0])
+        is_member = False
+        for members in network.channels.values():
+            try:
+                bits = members.pop(key)
+            except KeyError:
+                continue
+            is_member = True
+            members[intern(new_key)] = bits
+        network.nicks.pop(key, None)
+        if is_member:
+            network.add_nick(params[0])
+
+    def __irc_mode(self, prefix, this_command, params):
+        network = self.__get_network()
+        members = network.channels.get(network.fold(params[0]))
+        if members is None:
+            # User modes or an untracked channel.
+            return
+        args = iter(params[2:])
+        is_set = True
+        for mode in params[1]:
+            if mode in "+-":
+                is_set = mode == "+"
+            elif mode in network.mode_bits:
+                nick = next(args, None)
+                if nick is None:
+                    continue
+                key = network.fold(nick)
+                if key in members:
+                    if is_set:
+                        members[key] |= network.mode_bits[mode]
+                    else:
+                        members[key] &= ~network.mode_bits[mode]
+            elif mode in (network.param_modes if is_set
+                          else network.unset_param_modes):
+                next(args, None)
+
+    def __command_channels(self, nick, host, channel, this_command, argstr):
+        network = self.__get_network()
+        counts = ["%s: %d" % (c, len(m))
+                  for c, m in sorted(network.channels.items())]
+        nicks = set()
+        for members in network.channels.values():
+            nicks.update(members)
+        self.__bot.irc.send_privmsgs(channel,
+                                     ["%s: %s" % (nick, ", ".join(counts) or "no channels"),
+                                      "%d unique nicks, %.1f KiB in all networks"
+                                      % (len(nicks), self.memory_usage() / 1024)])
+
+def check_conf(conf):
+    t2jrbot.conf.check_keys(conf, ())
+
+def load(bot, conf):
+    check_conf(conf)
+
+    return _ChannelsPlugin(bot)
@@ -20,16 +20,95 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import Queue
+import threading
+import time
+import types
+
 import t2jrbot.conf
+import t2jrbot.stats
+
+class Error(Exception):
+    pass
+
+class _WorkerPool(object):
+
+    def __init__(self, size):
+        self.__size = size
+        self.__tasks = Queue.Queue()
+        self.__threads = []
+
+    def submit(self, func, *args):
+        if not self.__threads:
+            # Start threads lazily, most bots never need them.
+            for _ in range(self.__size):
+                thread = threading.Thread(target=self.__work)
+                # Handlers might be stuck forever, do not let them
+                # prevent the bot from exiting.
+                thread.daemon = True
+                thread.start()
+                self.__threads.append(thread)
+        self.__tasks.put((func, args))
+
+    def close(self):
+        for _ in self.__threads:
+            self.__tasks.put(None)
+        self.__threads = []
+
+    def __work(self):
+        while True:
+            task = self.__tasks.get()
+            if task is None:
+                break
+            func, args = task
+            func(*args)
+
+class _Job(object):
+
+    def __init__(self, irc, nick, channel, command):
+        self.irc = irc
+        self.nick = nick
+        self.channel = channel
+        self.command = command
+        self.start_time = time.time()
+        self.timer = None
+        self.is_timed_out = False
 
 class _CommandPlugin(object):
 
-    def __init__(self, bot):
+    # Execution policies of command handlers.
+    POLICY_INLINE = "inline"
+    POLICY_THREAD = "thread"
+
+    MAX_VERDICT_CACHE_SIZE = 1024
+
+    def __init__(self, bot, workers, bare_commands):
         self.__bot = bot
         self.__command_handlers = {}
         self.__command_descriptions = {}
+        self.__command_policies = {}
+        self.__command_jobs = {} # Maps commands to numbers of running jobs.
+        self.__command_histograms = {}
+
+        self.__worker_pool = _WorkerPool(workers)
 
+        # Maps commands (None for all commands) to lists of (priority,
+        # sequence number, hook, cache TTL) tuples.
         self.__pre_eval_hooks = {}
+        self.__pre_eval_hook_histograms = {}
+        self.__pre_eval_hook_count = 0
+        self.__pre_eval_countdown = t2jrbot.stats.sample_gap()
+        # Maps commands to tuples of (hook, cache TTL) pairs in the
+        # order of evaluation.
+        self.__pre_eval_pipelines = {}
+        # Maps (hook, nick, host, command) tuples to (verdict,
+        # expiration time) pairs.
+        self.__verdict_cache = {}
+
+        self.__bare_commands = bare_commands
+        # Maps nicks to the prefixes addressing them, computed when
+        # the bot gets a new nick.
+        self.__address_prefixes = {}
 
         self.__bot.add_irc_callback(self.__irc_privmsg, command="PRIVMSG")
         self.register_command("!help", self.__command_help,
@@ -37,19 +116,18 @@ class _CommandPlugin(object):
                               "you already know what this command does.")
 
     def release(self):
-        pass
+        self.__worker_pool.close()
 
     def __command_help(self, nick, host, channel, this_command, argstr):
         command = argstr.strip()
         if not command:
             commands = sorted(self.__command_descriptions.keys())
-            self.__bot.irc.send_privmsg(channel,
-                                        "%s: Commands: %s"
-                                        % (nick, ", ".join(commands)))
-            self.__bot.irc.send_privmsg(channel,
-                                        "%s: To get detailed help on a command, "
-                                        "use %s COMMAND, e.g. %s %s"
-                                        % (nick, this_command, this_command, this_command))
+            self.__bot.irc.send_privmsgs(channel,
+                                         ["%s: Commands: %s"
+                                          % (nick, ", ".join(commands)),
+                                          "To get detailed help on a command, "
+                                          "use %s COMMAND, e.g. %s %s"
+                                          % (this_command, this_command, this_command)])
         else:
             try:
                 descr = self.__command_descriptions[command]
@@ -60,15 +138,97 @@ class _CommandPlugin(object):
                 self.__bot.irc.send_privmsg(channel, "%s: %s - %s"
                                             % (nick, command, descr))
 
-    def add_pre_eval_hook(self, hook, command=None):
-        hooks = self.__pre_eval_hooks.setdefault(command, set())
-        hooks.add(hook)
+    def add_pre_eval_hook(self, hook, command=None, priority=0,
+                          cache_ttl=None):
+        """Add a hook which decides whether a command is evaluated.
+
+        The hook is called with the same arguments as command handlers
+        and returns True to allow the command. Hooks are called for
+        registered commands only, or just for `command` if it is
+        given. Hooks with lower `priority` are called first, hooks
+        with the same priority in the order they were added. The first
+        hook denying the command stops the evaluation.
+
+        If `cache_ttl` is given, the verdict of the hook is reused for
+        the same nick, host and command for `cache_ttl` seconds, or
+        until invalidate_pre_eval_verdicts() is called. Such hooks must
+        not depend on the channel or the arguments and must not have
+        side effects.
+
+        """
+        hooks = self.__pre_eval_hooks.setdefault(command, [])
+        hooks.append((priority, self.__pre_eval_hook_count, hook, cache_ttl))
+        hooks.sort()
+        self.__pre_eval_hook_count += 1
+        self.__pre_eval_pipelines.clear()
+        name = "hook:%s" % t2jrbot.stats.callable_name(hook)
+        self.__pre_eval_hook_histograms[hook] = self.__bot.stats.histogram(name)
+        self.__bot.add_release_callback(self.remove_pre_eval_hook, hook, command)
 
-    def register_command(self, command, handler, description=""):
+    def remove_pre_eval_hook(self, hook, command=None):
+        hooks = self.__pre_eval_hooks.get(command, [])
+        for i, (_, _, h, _) in enumerate(hooks):
+            if h == hook:
+                del hooks[i]
+                break
+        else:
+            raise Error("pre-eval hook is not added")
+        self.__pre_eval_pipelines.clear()
+        self.invalidate_pre_eval_verdicts(hook)
+
+    def invalidate_pre_eval_verdicts(self, hook=None):
+        """Forget cached verdicts of `hook`, or of all hooks."""
+        if hook is None:
+            self.__verdict_cache.clear()
+            return
+        for key in [k for k in self.__verdict_cache if k[0] == hook]:
+            del self.__verdict_cache[key]
+
+    def __get_pre_eval_pipeline(self, command):
+        try:
+            return self.__pre_eval_pipelines[command]
+        except KeyError:
+            pass
+        hooks = sorted(self.__pre_eval_hooks.get(command, [])
+                       + self.__pre_eval_hooks.get(None, []))
+        pipeline = tuple([(hook, cache_ttl) for _, _, hook, cache_ttl in hooks])
+        self.__pre_eval_pipelines[command] = pipeline
+        return pipeline
+
+    def __get_address_prefixes(self, nick):
+        try:
+            return self.__address_prefixes[nick]
+        except KeyError:
+            prefixes = ("%s:" % nick, "%s," % nick)
+            self.__address_prefixes[nick] = prefixes
+            return prefixes
+
+    def register_command(self, command, handler, description="",
+                         policy=POLICY_INLINE, max_concurrency=None,
+                         timeout=None):
+        """Register a command handler.
+
+        With POLICY_INLINE, the handler is called in the bot loop and
+        must not block, but it can be a coroutine.
+
+        With POLICY_THREAD, the handler is called in a worker thread.
+        It can return a callable which is then called in the bot loop,
+        e.g. to send replies to the connection the command came
+        from. At most `max_concurrency` invocations of the command run
+        at the same time. If the handler does not finish in `timeout`
+        seconds, the user gets an error and the returned callable is
+        ignored.
+
+        """
         if command in self.__command_handlers:
             raise Error("command '%s' is already registered" % command)
+        if policy not in (_CommandPlugin.POLICY_INLINE, _CommandPlugin.POLICY_THREAD):
+            raise Error("invalid execution policy '%s'" % policy)
         self.__command_handlers[command] = handler
         self.__command_descriptions[command] = description
+        self.__command_policies[command] = (policy, max_concurrency, timeout)
+        self.__command_histograms[command] = self.__bot.stats.histogram("command:%s" % command)
+        self.__bot.add_release_callback(self.unregister_command, command)
 
     def unregister_command(self, command):
         try:
@@ -76,9 +236,13 @@ class _CommandPlugin(object):
         except KeyError:
             raise Error("command '%s' is not registered" % command)
         del self.__command_descriptions[command]
+        del self.__command_policies[command]
+        del self.__command_histograms[command]
+        self.__pre_eval_pipelines.pop(command, None)
 
     def __irc_privmsg(self, prefix, this_command, params):
-        nick, sep, host = prefix.partition("!")
+        message = self.__bot.current_message
+        nick, host = message.nick, message.userhost
 
         target, text = params
 
@@ -92,43 +256,171 @@ class _CommandPlugin(object):
         # Ignore all leading whitespaces.
         text = text.lstrip()
 
-        if not text.startswith("%s:" % self.__bot.nick):
+        # Commands are addressed to me with "nick: !cmd", "nick, !cmd"
+        # or, if enabled, just "!cmd".
+        if text.startswith(self.__get_address_prefixes(self.__bot.nick)):
+            # Strip my nick from the beginning of the text.
+            commandstr = text[len(self.__bot.nick) + 1:].lstrip()
+        elif self.__bare_commands and text.startswith("!"):
+            commandstr = text
+        else:
             # The message is not designated to me, ignore.
             return
 
-        # Strip my nick from the beginning of the text.
-        commandstr = text[len("%s:" % self.__bot.nick):].lstrip()
-
         command, _, argstr = commandstr.partition(' ')
 
         self.__eval_command(nick, host, channel, command, argstr)
 
     def __eval_command(self, nick, host, channel, command, argstr):
-        hooks = set()
-
-        hooks.update(self.__pre_eval_hooks.get(command, set()),
-                     self.__pre_eval_hooks.get(None, set()))
-
-        if not all([hook(nick, host, channel, command, argstr) for hook in hooks]):
-            return
-
         try:
             command_handler = self.__command_handlers[command]
         except KeyError:
             # Silently ignore all input except registered commands.
             return
 
+        # Like IRC callbacks, hooks are timed on some commands only.
+        self.__pre_eval_countdown -= 1
+        is_timed = not self.__pre_eval_countdown
+        if is_timed:
+            self.__pre_eval_countdown = t2jrbot.stats.sample_gap()
+
+        for hook, cache_ttl in self.__get_pre_eval_pipeline(command):
+            if not self.__eval_pre_eval_hook(hook, cache_ttl, is_timed, nick,
+                                             host, channel, command, argstr):
+                return
+
+        policy, max_concurrency, timeout = self.__command_policies[command]
+        if policy == _CommandPlugin.POLICY_THREAD:
+            self.__submit_job(command_handler, max_concurrency, timeout,
+                              nick, host, channel, command, argstr)
+            return
+
+        histogram = self.__command_histograms[command]
+
+        def report_error(e):
+            self.__bot.irc.send_privmsg(channel,
+                                        "%s: error: %s" % (nick, e.message))
+
+        # Only the time spent in the loop is measured, that is, up to
+        # the first yield of coroutines.
+        start = time.time()
         try:
-            command_handler(nick, host, channel, command, argstr)
+            result = command_handler(nick, host, channel, command, argstr)
+            if isinstance(result, types.GeneratorType):
+                # The handler is a coroutine, let it run alongside
+                # other handlers.
+                self.__bot.spawn(result, report_error)
         except Exception, e:
+            report_error(e)
+        finally:
+            histogram.add(time.time() - start)
+
+    def __eval_pre_eval_hook(self, hook, cache_ttl, is_timed, nick, host,
+                             channel, command, argstr):
+        if cache_ttl is not None:
+            now = time.time()
+            key = (hook, nick, host, command)
+            try:
+                verdict, expiration_time = self.__verdict_cache[key]
+            except KeyError:
+                pass
+            else:
+                if now < expiration_time:
+                    return verdict
+
+        histogram = self.__pre_eval_hook_histograms[hook]
+        histogram.count += 1
+        if is_timed:
+            start = time.time()
+            verdict = bool(hook(nick, host, channel, command, argstr))
+            histogram.add_sample(time.time() - start)
+        else:
+            verdict = bool(hook(nick, host, channel, command, argstr))
+
+        if cache_ttl is not None:
+            if len(self.__verdict_cache) >= _CommandPlugin.MAX_VERDICT_CACHE_SIZE:
+                # Nicks and hosts are practically unbounded, do not let
+                # the cache grow with them.
+                self.__verdict_cache.clear()
+            self.__verdict_cache[key] = (verdict, now + cache_ttl)
+
+        return verdict
+
+    def __submit_job(self, command_handler, max_concurrency, timeout,
+                     nick, host, channel, command, argstr):
+        running = self.__command_jobs.get(command, 0)
+        if max_concurrency is not None and running >= max_concurrency:
             self.__bot.irc.send_privmsg(channel,
-                                        "%s: error: %s" % (nick, e.message))
+                                        "%s: error: %s is busy, try again later"
+                                        % (nick, command))
+            return
+        self.__command_jobs[command] = running + 1
+
+        job = _Job(self.__bot.irc, nick, channel, command)
+        if timeout is not None:
+            job.timer = self.__bot.call_later(timeout, self.__time_out_job, job)
+
+        def work():
+            # Runs in a worker thread, results are posted back to the
+            # bot loop.
+            try:
+                result = command_handler(nick, host, channel, command, argstr)
+            except Exception, e:
+                result, error = None, e
+            else:
+                error = None
+            self.__bot.call_soon(self.__bot.call_with_irc, job.irc,
+                                 self.__finish_job, job, result, error)
+
+        self.__worker_pool.submit(work)
+
+    def __time_out_job(self, job):
+        job.is_timed_out = True
+        self.__bot.irc.send_privmsg(job.channel,
+                                    "%s: error: %s timed out"
+                                    % (job.nick, job.command))
+
+    def __finish_job(self, job, result, error):
+        # The slot is not freed on timeout, because the thread is
+        # still running.
+        self.__command_jobs[job.command] -= 1
 
+        # Thread handlers are measured from submission to completion.
+        self.__bot.stats.histogram("command:%s" % job.command).add(time.time() - job.start_time)
+
+        if job.timer is not None:
+            job.timer.cancel()
+
+        if job.is_timed_out:
+            return
+
+        if error is None and callable(result):
+            # The callback runs in the bot loop, it must not take the
+            # loop down with it.
+            try:
+                result()
+            except Exception, e:
+                error = e
+
+        if error is not None:
+            self.__bot.irc.send_privmsg(job.channel,
+                                        "%s: error: %s" % (job.nick, error.message))
 
 def check_conf(conf):
-    t2jrbot.conf.check_keys(conf, ())
+    t2jrbot.conf.check_keys(conf, ["workers", "bare_commands"])
+
+    t2jrbot.conf.check_value(conf, "workers",
+                             lambda v: isinstance(v, int) and v > 0,
+                             required=False)
+
+    t2jrbot.conf.check_value(conf, "bare_commands",
+                             lambda v: isinstance(v, bool),
+                             required=False)
 
 def load(bot, conf):
     check_conf(conf)
 
-    return _CommandPlugin(bot)
+    workers = conf.get("workers", 4)
+    bare_commands = conf.get("bare_commands", False)
+
+    return _CommandPlugin(bot, workers, bare_commands)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+# Plugin management plugin for t2jrbot.
+# Copyright © 2014 Tuomas Räsänen <tuomasjjrasanen@tjjr.fi>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import re
+
+import t2jrbot.conf
+import t2jrbot.plugins.admin
+
+# Only modules of the plugin package can be loaded from IRC, anything
+# else could run arbitrary module-level code.
+_RE_PLUGIN = re.compile(r"^t2jrbot\.plugins\.[a-zA-Z_][a-zA-Z_0-9]*$")
+
+DEPENDENCIES = ["t2jrbot.plugins.command"]
+
+class _PluginsPlugin(object):
+
+    def __init__(self, bot):
+        self.__bot = bot
+
+        command_plugin = self.__bot.plugins["t2jrbot.plugins.command"]
+        command_plugin.register_command("!plugin_list", self.__command_plugin_list,
+                                        "List loaded plugins. Usage: !plugin_list")
+        command_plugin.register_command("!plugin_load", self.__command_plugin_load,
+                                        "Load a plugin with the configuration "
+                                        "it had when last loaded. Usage: !plugin_load MODULE, "
+                                        "e.g. !plugin_load t2jrbot.plugins.topic")
+        command_plugin.register_command("!plugin_unload", self.__command_plugin_unload,
+                                        "Unload a plugin. Usage: !plugin_unload MODULE, "
+                                        "e.g. !plugin_unload t2jrbot.plugins.topic")
+        command_plugin.register_command("!plugin_reload", self.__command_plugin_reload,
+                                        "Reload the code of a plugin and load it "
+                                        "again with its configuration. "
+                                        "Usage: !plugin_reload MODULE, "
+                                        "e.g. !plugin_reload t2jrbot.plugins.topic")
+
+        t2jrbot.plugins.admin.require_admins(self.__bot, ["!plugin_list",
+                                                          "!plugin_load",
+                                                          "!plugin_unload",
+                                                          "!plugin_reload"])
+
+    def release(self):
+        pass
+
+    def __parse_plugin_arg(self, argstr):
+        name = argstr.strip()
+        if not name:
+            raise ValueError("plugin module name is missing")
+        if not _RE_PLUGIN.match(name):
+            raise ValueError("plugin module name must be t2jrbot.plugins.NAME")
+        return name
+
+    def __command_plugin_list(self, nick, host, channel, this_command, argstr):
+        names = sorted(self.__bot.plugins.keys())
+        self.__bot.irc.send_privmsg(channel, "%s: %s" % (nick, ", ".join(names)))
+
+    def __command_plugin_load(self, nick, host, channel, this_command, argstr):
+        name = self.__parse_plugin_arg(argstr)
+        self.__bot.load_plugin(name)
+        self.__bot.irc.send_privmsg(channel, "%s: Loaded %s." % (nick, name))
+
+    def __command_plugin_unload(self, nick, host, channel, this_command, argstr):
+        name = self.__parse_plugin_arg(argstr)
+        self.__bot.unload_plugin(name)
+        self.__bot.irc.send_privmsg(channel, "%s: Unloaded %s." % (nick, name))
+
+    def __command_plugin_reload(self, nick, host, channel, this_command, argstr):
+        name = self.__parse_plugin_arg(argstr)
+        self.__bot.reload_plugin(name)
+        self.__bot.irc.send_privmsg(channel, "%s: Reloaded %s." % (nick, name))
+
+def check_conf(conf):
+    t2jrbot.conf.check_keys(conf, ())
+
+def load(bot, conf):
+    check_conf(conf)
+
+    return _PluginsPlugin(bot)
@@ -20,25 +20,158 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
+import time
+
 import t2jrbot.conf
 
+DEPENDENCIES = ["t2jrbot.plugins.command"]
+
+class _Link(object):
+
+    def __init__(self, window):
+        self.token = None # Token of the PING waiting for a PONG.
+        self.ping_time = None
+        self.misses = 0
+        self.lags = collections.deque(maxlen=window)
+        self.timer = None
+
 class _PongPlugin(object):
+    """Answer server PINGs and measure lag with PINGs of our own.
+
+    A PING is sent every `interval` seconds, unless the previous one
+    is still unanswered. Each interval a PING waits for its PONG is a
+    miss, and after `max_misses` of them the connection is dropped and
+    reconnected. A late PONG still counts, so lags longer than the
+    interval are measured too.
 
-    def __init__(self, bot):
+    """
+
+    def __init__(self, bot, interval, max_misses, window):
         self.__bot = bot
+        self.__interval = interval
+        self.__max_misses = max_misses
+        self.__window = window
+        self.__links = {} # Maps connection names to _Link objects.
+        self.__lag_histogram = self.__bot.stats.histogram("pong:lag")
 
         self.__bot.add_irc_callback(self.__irc_ping, command="PING")
+        self.__bot.add_irc_callback(self.__irc_pong, command="PONG")
+        self.__bot.add_connect_callback(self.__connected)
+
+        command_plugin = self.__bot.plugins["t2jrbot.plugins.command"]
+        command_plugin.register_command("!lag", self.__command_lag,
+                                        "Show the round-trip time to the "
+                                        "server. Usage: !lag")
 
     def release(self):
-        pass
+        for link in self.__links.values():
+            if link.timer is not None:
+                link.timer.cancel()
+
+    def get_lag(self):
+        """Return the latest lag of the current connection in seconds.
+
+        None means that it is not known yet. While a PING is
+        unanswered for longer than the latest lag, the time waited so
+        far is returned.
+
+        """
+        link = self.__links.get(self.__bot.irc.name)
+        if link is None or not link.lags:
+            return None
+        lag = link.lags[-1]
+        if link.token is not None:
+            lag = max(lag, time.time() - link.ping_time)
+        return lag
+
+    def get_lags(self):
+        """Return recent lags of the current connection, oldest first."""
+        link = self.__links.get(self.__bot.irc.name)
+        if link is None:
+            return []
+        return list(link.lags)
+
+    def __connected(self):
+        name = self.__bot.irc.name
+        link = self.__links.get(name)
+        if link is not None and link.timer is not None:
+            link.timer.cancel()
+        link = self.__links[name] = _Link(self.__window)
+        link.timer = self.__bot.call_later(self.__interval, self.__ping, link)
+
+    def __ping(self, link):
+        irc = self.__bot.irc
+        if self.__links.get(irc.name) is not link or not irc.is_connected:
+            # Lost or replaced by a new connection.
+            link.timer = None
+            return
+
+        if link.token is not None:
+            # A new PING would make the PONG to this one look stale,
+            # keep waiting for it instead.
+            link.misses += 1
+            if link.misses >= self.__max_misses:
+                link.timer = None
+                self.__bot.drop_connection("no PONG in %.0f seconds"
+                                           % (time.time() - link.ping_time))
+                return
+        else:
+            now = time.time()
+            link.token = "t2jrbot-%.6f" % now
+            link.ping_time = now
+            irc.send_ping(link.token)
+        link.timer = self.__bot.call_later(self.__interval, self.__ping, link)
 
     def __irc_ping(self, prefix, this_command, params):
-        self.__bot.irc.send_pong(self.__bot.nick)
+        # Echo the token, servers match it to their PING.
+        self.__bot.irc.send_pong(params[-1] if params else self.__bot.nick)
+
+    def __irc_pong(self, prefix, this_command, params):
+        # ":server PONG server :token"
+        link = self.__links.get(self.__bot.irc.name)
+        if link is None or not params or params[-1] != link.token:
+            return
+        lag = time.time() - link.ping_time
+        link.token = None
+        link.misses = 0
+        link.lags.append(lag)
+        self.__lag_histogram.add(lag)
+
+    def __command_lag(self, nick, host, channel, this_command, argstr):
+        lag = self.get_lag()
+        if lag is None:
+            self.__bot.irc.send_privmsg(channel, "%s: Lag is not measured yet." % nick)
+            return
+        lags = sorted(self.get_lags())
+        self.__bot.irc.send_privmsg(channel,
+                                    "%s: Lag %.0f ms, last %d: min %.0f ms, "
+                                    "median %.0f ms, max %.0f ms"
+                                    % (nick, lag * 1000, len(lags),
+                                       lags[0] * 1000,
+                                       lags[len(lags) // 2] * 1000,
+                                       lags[-1] * 1000))
 
 def check_conf(conf):
-    t2jrbot.conf.check_keys(conf, ())
+    t2jrbot.conf.check_keys(conf, ["interval", "max_misses", "window"])
+
+    t2jrbot.conf.check_value(conf, "interval",
+                             lambda v: isinstance(v, (int, float)) and v > 0,
+                             required=False)
+
+    t2jrbot.conf.check_value(conf, "max_misses",
+                             lambda v: isinstance(v, int) and v > 0,
+                             required=False)
+
+    t2jrbot.conf.check_value(conf, "window",
+                             lambda v: isinstance(v, int) and v > 0,
+                             required=False)
 
 def load(bot, conf):
     check_conf(conf)
 
-    return _PongPlugin(bot)
+    interval = conf.get("interval", 10)
+    max_misses = conf.get("max_misses", 3)
+    window = conf.get("window", 20)
+
+    return _PongPlugin(bot, interval, max_misses, window)
@@ -22,6 +22,8 @@ from __future__ import print_function
 
 import t2jrbot.conf
 
+DEPENDENCIES = ["t2jrbot.plugins.command"]
+
 class _QuitPlugin(object):
 
     def __init__(self, bot):
@@ -38,7 +40,8 @@ class _QuitPlugin(object):
 
     def __command_quit(self, nick, host, channel, this_command, argstr):
         self.__bot.stop()
-        self.__bot.irc.send_quit(argstr)
+        for irc in self.__bot.connections.values():
+            irc.send_quit(argstr)
 
 def check_conf(conf):
     t2jrbot.conf.check_keys(conf, ())
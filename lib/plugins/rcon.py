@@ -20,25 +20,74 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import os
+import os.path
 import re
-import select
-import subprocess
-import threading
+import time
 
 import t2jrbot.conf
+import t2jrbot.core
+import t2jrbot.rcon
 
-_CLIENT_CONNECT_PATTERN = re.compile(r"^\s*\d+:\d+\s*ClientConnect: \d+, Name: (.*), .*$")
+DEPENDENCIES = ["t2jrbot.plugins.command"]
+
+# Splits gamelog lines to event names and event arguments.
+_EVENT_PATTERN = re.compile(r"^\s*\d+:\d+\s*(\w+):\s*(.*)$")
+
+# Maps event names to patterns matching event arguments.
+_EVENT_ARGS_PATTERNS = {
+    "ClientConnect": re.compile(r"^(\d+), Name: (.*), .*$"),
+    "ClientDisconnect": re.compile(r"^(\d+)$"),
+    "Kill": re.compile(r"^\d+ \d+ \d+: (.*) killed (.*) by (\w+)$"),
+    "InitGame": re.compile(r"^.*\\mapname\\([^\\]*).*$"),
+    "say": re.compile(r"^(.*?): (.*)$"),
+}
+
+# Maps event kinds to (separator, template for one event, template for
+# many events) tuples used to aggregate events of the same kind to a
+# single message.
+_EVENT_FORMATS = {
+    "connect": (", ", "%(last)s connected.",
+                "%(count)d players connected: %(items)s"),
+    "disconnect": (", ", "%(last)s disconnected.",
+                   "%(count)d players disconnected: %(items)s"),
+    "kill": (", ", "%(last)s",
+             "%(count)d kills: %(items)s"),
+    "map": (", ", "Map changed to %(last)s.",
+            "Map changed to %(last)s."),
+    "chat": (" | ", "%(last)s",
+             "%(items)s"),
+}
 
 class _RconPlugin(object):
 
-    def __init__(self, bot, server, port, password, gamelog, gamelog_channels):
+    _GAMELOG_OFFSET_FILE = os.path.expanduser("~/.t2jrbot/plugins/rcon/gamelog_offset")
+
+    def __init__(self, bot, server, port, password, timeout, status_ttl,
+                 gamelog, gamelog_channels, gamelog_events, gamelog_window):
         self.__bot = bot
-        self.__server = server
-        self.__port = port
-        self.__password = password
-        self.__gamelog = gamelog
+        self.__rcon_client = t2jrbot.rcon.Client(server, port, password,
+                                                 timeout)
+
+        # Parsed status, (gamemap, players) or None if there is not
+        # any game running, and the time it was queried.
+        self.__status = None
+        self.__status_time = None
+        self.__status_ttl = status_ttl
+        self.__status_future = None # Set while a query is in flight.
+
         self.__gamelog_channels = gamelog_channels
+        self.__gamelog_events = set(gamelog_events)
+        self.__gamelog_window = gamelog_window
+        self.__gamelog_client_names = {} # Maps client numbers to names.
+        self.__gamelog_pending = {} # Maps event kinds to lists of items.
+
+        self.__gamelog_handlers = {
+            "ClientConnect": self.__gamelog_client_connect,
+            "ClientDisconnect": self.__gamelog_client_disconnect,
+            "Kill": self.__gamelog_kill,
+            "InitGame": self.__gamelog_init_game,
+            "say": self.__gamelog_say,
+        }
 
         command_plugin = self.__bot.plugins["t2jrbot.plugins.command"]
         command_plugin.register_command("!rcon_status", self.__command_rcon_status,
@@ -48,63 +97,88 @@ class _RconPlugin(object):
                                         "Say something in the game. "
                                         "Usage: !rcon_say Pizzas are here!")
 
-        self.__gamelog_monitor = None
-        if self.__gamelog:
-            self.__gamelog_monitor = threading.Thread(target=self.__monitor_gamelog)
-            self.__gamelog_monitor_rpipe, self.__gamelog_monitor_wpipe = os.pipe()
-            self.__gamelog_monitor.start()
-
-    def __monitor_gamelog(self):
-        with open(self.__gamelog) as gamelog_file:
-            gamelog_file.seek(0, 2) # Ignore existing, historical,
-                                    # content. We care only about new
-                                    # events.
-            while True:
-                # Loop forever.
-                rds = [gamelog_file, self.__gamelog_monitor_rpipe]
-                rds, _, _ = select.select(rds, [], [])
-                if gamelog_file in rds:
-                    for line in gamelog_file.readlines():
-                        match = _CLIENT_CONNECT_PATTERN.match(line)
-                        if match:
-                            name = match.group(1)
-                            for channel in self.__gamelog_channels:
-                                self.__bot.irc.send_privmsg(channel,
-                                                            "%s connected."
-                                                            % name)
-                if self.__gamelog_monitor_rpipe in rds:
-                    # Stop monitoring.
-                    break
+        self.__gamelog_tailer = None
+        if gamelog:
+            # Imported only when needed, it sets up inotify via ctypes.
+            from t2jrbot.tail import Tailer
+            self.__gamelog_tailer = Tailer(self.__bot, gamelog,
+                                           self.__gamelog_line,
+                                           _RconPlugin._GAMELOG_OFFSET_FILE)
 
-    def release(self):
-        if self.__gamelog_monitor is not None:
-            os.close(self.__gamelog_monitor_wpipe) # Stop monitoring.
-            self.__gamelog_monitor.join()
-
-    def __crcon(self, rcon_cmd):
-        args = ["crcon"]
-        if self.__password:
-            args.append("-p")
-            args.append(self.__password)
-        args.append("-P")
-        args.append("%d" % self.__port)
-        args.append(self.__server)
-        args.append(rcon_cmd)
-
-        out = subprocess.check_output(args)
+    def __gamelog_line(self, line):
+        match = _EVENT_PATTERN.match(line)
+        if not match:
+            return
+        event, argstr = match.groups()
+        try:
+            args_pattern = _EVENT_ARGS_PATTERNS[event]
+        except KeyError:
+            return
+        match = args_pattern.match(argstr)
+        if match:
+            self.__gamelog_handlers[event](*match.groups())
 
-        if not out.strip():
-            return False, out
+    def __gamelog_client_connect(self, client, name):
+        self.__gamelog_client_names[client] = name
+        self.__gamelog_event("connect", name)
 
-        return True, out.lstrip("\xff ") # Remove preceding garbage.
+    def __gamelog_client_disconnect(self, client):
+        name = self.__gamelog_client_names.pop(client, "#%s" % client)
+        self.__gamelog_event("disconnect", name)
 
-    def __command_rcon_status(self, nick, host, channel, this_command, argstr):
-        ok, out = self.__crcon("status")
-        if not ok:
-            self.__bot.irc.send_privmsg(channel,
-                                        "%s: There is not any game running at the moment." % nick)
+    def __gamelog_kill(self, killer, victim, weapon):
+        self.__gamelog_event("kill", "%s killed %s by %s"
+                             % (killer, victim, weapon))
+
+    def __gamelog_init_game(self, gamemap):
+        self.__gamelog_client_names.clear()
+        self.__gamelog_event("map", gamemap)
+
+    def __gamelog_say(self, name, text):
+        self.__gamelog_event("chat", "<%s> %s" % (name, text))
+
+    def __gamelog_event(self, kind, item):
+        if kind not in self.__gamelog_events:
             return
+        items = self.__gamelog_pending.setdefault(kind, [])
+        items.append(item)
+        if len(items) == 1:
+            # Collect events happening during the window to a single
+            # message.
+            self.__bot.call_later(self.__gamelog_window,
+                                  self.__flush_gamelog_events, kind)
+
+    def __flush_gamelog_events(self, kind):
+        items = self.__gamelog_pending.pop(kind, [])
+        if not items:
+            return
+        separator, one_template, many_template = _EVENT_FORMATS[kind]
+        template = one_template if len(items) == 1 else many_template
+        text = template % {"count": len(items),
+                           "items": separator.join(items),
+                           "last": items[-1]}
+        for channel in self.__gamelog_channels:
+            self.__bot.irc.send_privmsg(channel, text,
+                                        self.__bot.irc.PRIORITY_LOW)
+
+    def release(self):
+        if self.__gamelog_tailer is not None:
+            self.__gamelog_tailer.close()
+        self.__rcon_client.close()
+
+    def __rcon(self, rcon_cmd, result):
+        # A coroutine which appends (ok, output) to the `result` list.
+        out = []
+        for wait in self.__rcon_client.iter_query(rcon_cmd, out):
+            yield wait
+        out = out[0]
 
+        if not out.strip():
+            result.append((False, out))
+        else:
+            result.append((True, out.lstrip()))
+
+    def __parse_status(self, out):
         gamemap = ""
         players = []
         is_playerlist_reached = False
@@ -119,21 +193,73 @@ class _RconPlugin(object):
                 parts = line.split()
                 if parts:
                     players.append(parts[3])
+        return gamemap, tuple(players)
+
+    def __refresh_status(self, future):
+        try:
+            result = []
+            for wait in self.__rcon("status", result):
+                yield wait
+            ok, out = result[0]
+            status = self.__parse_status(out) if ok else None
+        except Exception, e:
+            self.__status_future = None
+            future.set_exception(e)
+            return
+
+        self.__status = status
+        self.__status_time = time.time()
+        self.__status_future = None
+        future.set_result(status)
+
+    def __query_status(self, result):
+        # A coroutine which appends the parsed status to the `result`
+        # list. Fresh enough statuses are served from the cache and
+        # concurrent queries share the one in flight.
+        if (self.__status_time is not None
+            and time.time() - self.__status_time < self.__status_ttl):
+            result.append(self.__status)
+            return
+
+        future = self.__status_future
+        if future is None:
+            future = self.__status_future = t2jrbot.core.Future()
+            self.__bot.spawn(self.__refresh_status(future))
+
+        yield future
+        if future.exception is not None:
+            raise future.exception
+        result.append(future.result)
 
+    def __command_rcon_status(self, nick, host, channel, this_command, argstr):
+        result = []
+        for wait in self.__query_status(result):
+            yield wait
+        status = result[0]
+        if status is None:
+            self.__bot.irc.send_privmsg(channel,
+                                        "%s: There is not any game running at the moment." % nick)
+            return
+
+        gamemap, players = status
         self.__bot.irc.send_privmsg(channel, "Map: %s / %d players: %s"
                                     % (gamemap, len(players),
                                        ", ".join(players)))
 
     def __command_rcon_say(self, nick, host, channel, this_command, argstr):
-        ok, out = self.__crcon("say %s" % argstr)
+        result = []
+        for wait in self.__rcon("say %s" % argstr, result):
+            yield wait
+        ok, out = result[0]
         if not ok:
             self.__bot.irc.send_privmsg(channel,
                                         "%s: There is not any game running at the moment." % nick)
             return
 
 def check_conf(conf):
-    t2jrbot.conf.check_keys(conf, ["server", "port", "password",
-                                   "gamelog", "gamelog_channels"])
+    t2jrbot.conf.check_keys(conf, ["server", "port", "password", "timeout",
+                                   "status_ttl", "gamelog", "gamelog_channels",
+                                   "gamelog_events", "gamelog_window"])
 
     t2jrbot.conf.check_value(conf, "server",
                              lambda v: isinstance(v, str),
@@ -147,6 +273,14 @@ def check_conf(conf):
                              lambda v: isinstance(v, str),
                              required=False)
 
+    t2jrbot.conf.check_value(conf, "timeout",
+                             lambda v: isinstance(v, (int, float)) and v > 0,
+                             required=False)
+
+    t2jrbot.conf.check_value(conf, "status_ttl",
+                             lambda v: isinstance(v, (int, float)) and v >= 0,
+                             required=False)
+
     t2jrbot.conf.check_value(conf, "gamelog",
                              lambda v: isinstance(v, str),
                              required=False)
@@ -156,13 +290,28 @@ def check_conf(conf):
                                          and all([isinstance(v, str) for v in vs])),
                              required=False)
 
+    t2jrbot.conf.check_value(conf, "gamelog_events",
+                             lambda vs: (isinstance(vs, list)
+                                         and all([v in _EVENT_FORMATS for v in vs])),
+                             required=False)
+
+    t2jrbot.conf.check_value(conf, "gamelog_window",
+                             lambda v: isinstance(v, (int, float)) and v >= 0,
+                             required=False)
+
 def load(bot, conf):
     check_conf(conf)
 
     server = conf.get("server", "localhost")
     port = conf.get("port", 27960)
     password = conf.get("password", None)
+    timeout = conf.get("timeout", 1.0)
+    status_ttl = conf.get("status_ttl", 10)
     gamelog = conf.get("gamelog", None)
     gamelog_channels = conf.get("gamelog_channels", [])
+    gamelog_events = conf.get("gamelog_events", ["connect"])
+    gamelog_window = conf.get("gamelog_window", 2)
 
-    return _RconPlugin(bot, server, port, password, gamelog, gamelog_channels)
+    return _RconPlugin(bot, server, port, password, timeout, status_ttl,
+                       gamelog, gamelog_channels, gamelog_events,
+                       gamelog_window)
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+# Stats plugin for t2jrbot.
+# Copyright © 2014 Tuomas Räsänen <tuomasjjrasanen@tjjr.fi>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import errno
+import os
+import os.path
+import time
+
+import t2jrbot.conf
+import t2jrbot.plugins.admin
+import t2jrbot.stats
+
+DEPENDENCIES = ["t2jrbot.plugins.command"]
+
+class _StatsPlugin(object):
+
+    _STATS_DIR = os.path.expanduser("~/.t2jrbot/plugins/stats")
+
+    def __init__(self, bot, max_lines):
+        self.__bot = bot
+        self.__max_lines = max_lines
+        self.__profile = None
+
+        command_plugin = self.__bot.plugins["t2jrbot.plugins.command"]
+        command_plugin.register_command("!stats", self.__command_stats,
+                                        "Show call counts and latencies of "
+                                        "IRC callbacks, pre-eval hooks and "
+                                        "commands, the most time consuming "
+                                        "first. IRC callbacks and pre-eval "
+                                        "hooks are timed on one call in %d on "
+                                        "average. Usage: !stats [FILTER], "
+                                        "e.g. !stats command:"
+                                        % t2jrbot.stats.SAMPLE_INTERVAL)
+        command_plugin.register_command("!stats_reset", self.__command_stats_reset,
+                                        "Reset statistics. Usage: !stats_reset")
+        command_plugin.register_command("!stats_profile", self.__command_stats_profile,
+                                        "Start or stop profiling the bot. "
+                                        "Usage: !stats_profile start|stop")
+
+        # Statistics and profiles reveal the inner workings of the bot.
+        t2jrbot.plugins.admin.require_admins(self.__bot, ["!stats", "!stats_reset",
+                                                          "!stats_profile"])
+
+    def release(self):
+        if self.__profile is not None:
+            self.__stop_profile()
+
+        self.__makedirs()
+        with open(os.path.join(_StatsPlugin._STATS_DIR, "stats"), "w") as f:
+            for histogram in self.__bot.stats.histograms():
+                f.write("%s\n" % histogram.summary())
+
+    def __makedirs(self):
+        try:
+            os.makedirs(_StatsPlugin._STATS_DIR)
+        except OSError, e:
+            # mkdir -p behavior
+            if e.errno != errno.EEXIST:
+                raise e
+
+    def __stop_profile(self):
+        self.__profile.disable()
+        self.__makedirs()
+        filepath = os.path.join(_StatsPlugin._STATS_DIR,
+                                time.strftime("profile-%Y%m%dT%H%M%S.pstats"))
+        self.__profile.dump_stats(filepath)
+        self.__profile = None
+        return filepath
+
+    def __command_stats(self, nick, host, channel, this_command, argstr):
+        pattern = argstr.strip()
+        histograms = [h for h in self.__bot.stats.histograms()
+                      if h.count and pattern in h.name]
+        if not histograms:
+            self.__bot.irc.send_privmsg(channel, "%s: No statistics." % nick)
+            return
+        summaries = [h.summary() for h in histograms[:self.__max_lines]]
+        summaries[0] = "%s: %s" % (nick, summaries[0])
+        self.__bot.irc.send_privmsgs(channel, summaries)
+
+    def __command_stats_reset(self, nick, host, channel, this_command, argstr):
+        self.__bot.stats.reset()
+
+    def __command_stats_profile(self, nick, host, channel, this_command, argstr):
+        action = argstr.strip()
+        if action == "start":
+            if self.__profile is not None:
+                raise ValueError("profiling is already running")
+            # Imported on first use, most bots never profile.
+            import cProfile
+            self.__profile = cProfile.Profile()
+            self.__profile.enable()
+            self.__bot.irc.send_privmsg(channel, "%s: Profiling started." % nick)
+        elif action == "stop":
+            if self.__profile is None:
+                raise ValueError("profiling is not running")
+            filepath = self.__stop_profile()
+            self.__bot.irc.send_privmsg(channel, "%s: Profile written to %s."
+                                        % (nick, filepath))
+        else:
+            raise ValueError("expected start or stop")
+
+def check_conf(conf):
+    t2jrbot.conf.check_keys(conf, ["max_lines"])
+
+    t2jrbot.conf.check_value(conf, "max_lines",
+                             lambda v: isinstance(v, int) and v > 0,
+                             required=False)
+
+def load(bot, conf):
+    check_conf(conf)
+
+    max_lines = conf.get("max_lines", 5)
+
+    return _StatsPlugin(bot, max_lines)
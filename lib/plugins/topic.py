@@ -20,27 +20,59 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
 import errno
-import os.path
-import pickle
+import os
 
 import t2jrbot.conf
+import t2jrbot.core
+
+DEPENDENCIES = ["t2jrbot.plugins.command"]
 
 class _TopicPlugin(object):
 
+    _JOURNAL_FILE = os.path.expanduser("~/.t2jrbot/plugins/topic/topic_journal")
+
+    # Before journaling, topic logs were pickled here on exit.
     _LOG_FILE = os.path.expanduser("~/.t2jrbot/plugins/topic/topic_logs")
 
+    # The journal is compacted when it has this many more records than
+    # the topic logs.
+    COMPACTION_SLACK = 64
+
     def __init__(self, bot, log_length):
         self.__bot = bot
-        self.__topic_logs = {} # Maps channels to lists of topics.
+        # Maps (connection name, channel) pairs to deques of topics,
+        # newest first.
+        self.__topic_logs = {}
         self.__log_length = log_length
+        self.__journal = None
+        self.__journal_records = 0
 
-        if os.path.exists(_TopicPlugin._LOG_FILE):
+        try:
+            os.makedirs(os.path.dirname(_TopicPlugin._JOURNAL_FILE))
+        except OSError, e:
+            # mkdir -p behavior
+            if e.errno != errno.EEXIST:
+                raise e
+
+        # Topics pickled by older versions belong to the default network.
+        if os.path.exists(_TopicPlugin._JOURNAL_FILE):
+            self.__replay_journal()
+        elif os.path.exists(_TopicPlugin._LOG_FILE):
+            import pickle
             with open(_TopicPlugin._LOG_FILE) as f:
                 topic_logs = pickle.load(f)
-            for lst in topic_logs.values():
-                del lst[self.__log_length:]
-            self.__topic_logs = topic_logs
+            for channel, topics in topic_logs.items():
+                for topic in reversed(topics):
+                    self.__log_topic(t2jrbot.core.IRC.DEFAULT_NAME, channel, topic)
+
+        # Start with a compact journal, it also drops a partial record
+        # a crash might have left at the end.
+        self.__compact_journal()
+
+        if os.path.exists(_TopicPlugin._LOG_FILE):
+            os.remove(_TopicPlugin._LOG_FILE)
 
         self.__bot.add_irc_callback(self.__irc_topic_callback, command="TOPIC")
 
@@ -53,22 +85,63 @@ class _TopicPlugin(object):
                                         "Usage: !topic_reset NUMBER")
 
     def release(self):
+        self.__compact_journal()
+        self.__journal.close()
+
+    def __log_topic(self, network, channel, topic):
+        key = (network, channel)
         try:
-            os.makedirs(os.path.dirname(_TopicPlugin._LOG_FILE))
-        except OSError, e:
-            # mkdir -p behavior
-            if e.errno != errno.EEXIST:
-                raise e
+            topic_log = self.__topic_logs[key]
+        except KeyError:
+            topic_log = collections.deque(maxlen=self.__log_length)
+            self.__topic_logs[key] = topic_log
+        topic_log.appendleft(topic)
+
+    def __replay_journal(self):
+        # Each record is a line "NETWORK CHANNEL TOPIC", network names
+        # are checked to have no spaces, channel names cannot contain
+        # spaces and topics cannot contain newlines.
+        with open(_TopicPlugin._JOURNAL_FILE) as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    # The bot crashed in the middle of a write.
+                    break
+                network, channel, topic = line[:-1].split(" ", 2)
+                self.__log_topic(network, channel, topic)
+
+    def __compact_journal(self):
+        if self.__journal is not None:
+            self.__journal.close()
+
+        tmp_path = "%s.tmp" % _TopicPlugin._JOURNAL_FILE
+        records = 0
         old_umask = os.umask(077)
         try:
-            with open(_TopicPlugin._LOG_FILE, "w") as f:
-                pickle.dump(self.__topic_logs, f)
+            with open(tmp_path, "w") as f:
+                for (network, channel), topic_log in self.__topic_logs.items():
+                    for topic in reversed(topic_log):
+                        f.write("%s %s %s\n" % (network, channel, topic))
+                        records += 1
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, _TopicPlugin._JOURNAL_FILE)
+            self.__journal = open(_TopicPlugin._JOURNAL_FILE, "a")
         finally:
             os.umask(old_umask)
+        self.__journal_records = records
+
+    def __append_journal(self, network, channel, topic):
+        self.__journal.write("%s %s %s\n" % (network, channel, topic))
+        self.__journal.flush()
+        os.fsync(self.__journal.fileno())
+        self.__journal_records += 1
+
+        retained_records = sum([len(l) for l in self.__topic_logs.values()])
+        if self.__journal_records > retained_records + _TopicPlugin.COMPACTION_SLACK:
+            self.__compact_journal()
 
     def __irc_topic_callback(self, prefix, cmd, params):
-        nick, sep, host = prefix.partition("!")
-        if nick == self.__bot.nick:
+        if self.__bot.current_message.nick == self.__bot.nick:
             # Do not log topics set by the bot, because it would
             # unnecessarily overwrite real entries. All topics set by
             # the bot are already in the log. 
@@ -76,23 +149,24 @@ class _TopicPlugin(object):
             # NOTE: This might change if other topic setting commands
             # gets implemented.
             return
+        network = self.__bot.irc.name
         channel, topic = params
-        topic_log = self.__topic_logs.setdefault(channel, [])
-        topic_log.insert(0, topic)
-        del topic_log[self.__log_length:]
+        self.__log_topic(network, channel, topic)
+        # Journal the change right away, a crash must not lose it.
+        self.__append_journal(network, channel, topic)
 
     def __command_topic_log(self, nick, host, channel, command, argstr):
-        try:
-            topic_log = self.__topic_logs[channel]
-        except KeyError:
+        topic_log = self.__topic_logs.get((self.__bot.irc.name, channel))
+        if not topic_log:
             self.__bot.irc.send_privmsg(channel, "%s: Topic log is empty." % nick)
             return
-        for i, topic in enumerate(topic_log, 1):
-            self.__bot.irc.send_privmsg(channel, "%s: %d: %s" % (nick, i, topic))
+        entries = ["%d: %s" % (i, topic) for i, topic in enumerate(topic_log, 1)]
+        entries[0] = "%s: %s" % (nick, entries[0])
+        self.__bot.irc.send_privmsgs(channel, entries)
 
     def __command_topic_reset(self, nick, host, channel, command, argstr):
         try:
-            topic_log = self.__topic_logs[channel]
+            topic_log = self.__topic_logs[(self.__bot.irc.name, channel)]
         except KeyError:
             self.__bot.irc.send_privmsg(channel, "%s: Topic log is empty." % nick)
             return
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+# t2jrbot - simple but elegant IRC bot
+# Copyright © 2014 Tuomas Räsänen <tuomasjjrasanen@tjjr.fi>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import errno
+import select
+import socket
+import time
+
+# Every out-of-band packet of the Quake 3 protocol starts with these.
+OOB_HEADER = b"\xff\xff\xff\xff"
+PRINT_HEADER = OOB_HEADER + b"print\n"
+
+class Client(object):
+    """Quake 3 style rcon client.
+
+    One UDP socket is kept per server and reused for all queries.
+    Servers split long responses into multiple packets without any
+    framing, so a response is considered complete when no packets have
+    arrived in `packet_timeout` seconds. If nothing at all arrives in
+    `timeout` seconds, the response is empty.
+
+    """
+
+    def __init__(self, server, port, password=None, timeout=1.0,
+                 packet_timeout=0.2):
+        self.__server = server
+        self.__port = port
+        self.__password = password
+        self.__timeout = timeout
+        self.__packet_timeout = packet_timeout
+        self.__sock = None
+        self.__is_busy = False
+
+    def close(self):
+        if self.__sock is not None:
+            self.__sock.close()
+            self.__sock = None
+
+    def __socket(self):
+        if self.__sock is None:
+            addrinfo = socket.getaddrinfo(self.__server, self.__port, 0,
+                                          socket.SOCK_DGRAM)
+            family, socktype, proto, _, sockaddr = addrinfo[0]
+            sock = socket.socket(family, socktype, proto)
+            sock.setblocking(False)
+            # Connecting makes the kernel drop packets from others.
+            sock.connect(sockaddr)
+            self.__sock = sock
+        return self.__sock
+
+    def __recv_payloads(self, sock):
+        payloads = []
+        while True:
+            try:
+                packet = sock.recv(65535)
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                if e.errno == errno.ECONNREFUSED:
+                    # Nobody listens at the server port.
+                    break
+                raise
+            if packet.startswith(PRINT_HEADER):
+                payloads.append(packet[len(PRINT_HEADER):])
+            elif packet.startswith(OOB_HEADER):
+                payloads.append(packet[len(OOB_HEADER):])
+        return payloads
+
+    def iter_query(self, command, result):
+        """Send rcon `command` and collect the response.
+
+        This is a coroutine for Bot.spawn(). The response is appended
+        to the `result` list when the coroutine finishes.
+
+        """
+        while self.__is_busy:
+            # Responses to concurrent queries would get mixed.
+            yield self.__packet_timeout
+        self.__is_busy = True
+        try:
+            sock = self.__socket()
+
+            # Discard late packets of previous queries.
+            self.__recv_payloads(sock)
+
+            sock.send(b"%srcon %s %s\n" % (OOB_HEADER, self.__password or "",
+                                           command))
+
+            payloads = []
+            timeout = self.__timeout
+            deadline = time.time() + timeout
+            while True:
+                yield sock, timeout
+                new_payloads = self.__recv_payloads(sock)
+                if new_payloads:
+                    payloads.extend(new_payloads)
+                    timeout = self.__packet_timeout
+                    deadline = time.time() + timeout
+                else:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        break
+        finally:
+            self.__is_busy = False
+
+        result.append(b"".join(payloads))
+
+    def query(self, command):
+        """Send rcon `command` and return the response.
+
+        This blocks until the response is complete.
+
+        """
+        result = []
+        for wait in self.iter_query(command, result):
+            if isinstance(wait, tuple):
+                sock, timeout = wait
+                select.select([sock], [], [], timeout)
+            else:
+                time.sleep(wait)
+        return result[0]
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+# t2jrbot - simple but elegant IRC bot
+# Copyright © 2014 Tuomas Räsänen <tuomasjjrasanen@tjjr.fi>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import random
+import types
+
+_NUM_BUCKETS = 32
+
+# IRC callbacks and pre-eval hooks run for nearly every message, timing
+# each call would cost more than most of them take. Their calls are
+# counted, but only every SAMPLE_INTERVAL-th one on average is timed.
+SAMPLE_INTERVAL = 64
+
+def sample_gap():
+    """Return the number of calls until the next timed one.
+
+    The gap is random, a fixed one could keep timing the same message
+    of periodic traffic.
+
+    """
+    # Much cheaper than random.randint().
+    return int(random.random() * (2 * SAMPLE_INTERVAL - 1)) + 1
+
+def callable_name(func):
+    """Return a human-readable name of a function or a method."""
+    if isinstance(func, types.MethodType) and func.im_self is not None:
+        return "%s.%s" % (type(func.im_self).__name__, func.__name__)
+    return getattr(func, "__name__", repr(func))
+
+class Histogram(object):
+    """Call count and latency distribution.
+
+    Latencies are counted in buckets of powers of two microseconds, so
+    adding one costs only a few arithmetic operations. Calls which are
+    too frequent to be timed one by one are counted in `count` and
+    only some of them are timed with add_sample().
+
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.samples = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * _NUM_BUCKETS
+
+    def add(self, seconds):
+        self.count += 1
+        self.add_sample(seconds)
+
+    def add_sample(self, seconds):
+        """Add the latency of a call counted in `count` separately."""
+        self.samples += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        bucket = int(seconds * 1000000).bit_length()
+        if bucket >= _NUM_BUCKETS:
+            bucket = _NUM_BUCKETS - 1
+        self.buckets[bucket] += 1
+
+    def percentile(self, p):
+        """Return the upper bound of the p-th percentile in seconds."""
+        threshold = self.samples * p / 100
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= threshold:
+                return min(2 ** bucket / 1000000, self.max)
+        return self.max
+
+    def time_spent(self):
+        """Return the total time of all calls, estimated from the timed ones."""
+        if not self.samples:
+            return 0.0
+        return self.total / self.samples * self.count
+
+    def summary(self):
+        if not self.samples:
+            return "%s: n=%d" % (self.name, self.count)
+        return ("%s: n=%d avg=%.0fus p99=%.0fus max=%.0fus"
+                % (self.name, self.count, self.total / self.samples * 1000000,
+                   self.percentile(99) * 1000000, self.max * 1000000))
+
+class Stats(object):
+    """Named latency histograms."""
+
+    def __init__(self):
+        self.__histograms = {}
+        self.__collectors = []
+
+    def add_collector(self, func):
+        """Add a function which brings histograms up to date.
+
+        The function is called before histograms are read or reset, to
+        add calls counted elsewhere.
+
+        """
+        self.__collectors.append(func)
+
+    def __collect(self):
+        for func in self.__collectors:
+            func()
+
+    def histogram(self, name):
+        """Return the histogram called `name`, create it if needed."""
+        try:
+            return self.__histograms[name]
+        except KeyError:
+            histogram = self.__histograms[name] = Histogram(name)
+            return histogram
+
+    def histograms(self):
+        """Return all histograms, the most time consuming first."""
+        self.__collect()
+        return sorted(self.__histograms.values(),
+                      key=lambda h: h.time_spent(), reverse=True)
+
+    def reset(self):
+        self.__collect()
+        # Histograms are referenced elsewhere, reset them in place.
+        for histogram in self.__histograms.values():
+            histogram.reset()
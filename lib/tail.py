@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+# t2jrbot - simple but elegant IRC bot
+# Copyright © 2014 Tuomas Räsänen <tuomasjjrasanen@tjjr.fi>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import time
+
+# From <sys/inotify.h>.
+_IN_MODIFY = 0x00000002
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_NONBLOCK = os.O_NONBLOCK
+
+def _inotify_init():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(_IN_NONBLOCK)
+    except (OSError, AttributeError):
+        # Not Linux or too old libc.
+        return None, None
+    if fd < 0:
+        return None, None
+    return libc, fd
+
+class Tailer(object):
+    """Follow lines appended to a file, like tail -F.
+
+    Each complete line is passed to `callback` in the bot loop. The
+    file is watched with inotify when available. Otherwise it is
+    polled at intervals growing from `min_poll_interval` to
+    `max_poll_interval` seconds while the file is idle.
+
+    Truncation and rotation (a new file at the same path) are detected
+    and the file is reopened. If `offset_file` is given, the position
+    is persisted there and restored on the next start. Otherwise, or
+    if the file has been rotated meanwhile, tailing starts from the
+    end of the file.
+
+    """
+
+    OFFSET_SAVE_INTERVAL = 5
+
+    def __init__(self, bot, path, callback, offset_file=None,
+                 min_poll_interval=0.25, max_poll_interval=5.0):
+        self.__bot = bot
+        self.__path = path
+        self.__callback = callback
+        self.__offset_file = offset_file
+        self.__min_poll_interval = min_poll_interval
+        self.__max_poll_interval = max_poll_interval
+        self.__poll_interval = min_poll_interval
+        self.__poll_timer = None
+
+        self.__fd = None
+        self.__inode = None
+        self.__offset = 0 # Offset of the end of the last complete line.
+        self.__partial = b""
+        self.__offset_saved_time = 0
+
+        self.__inotify_fd = None
+        libc, inotify_fd = _inotify_init()
+        if inotify_fd is not None:
+            # Watch the directory to catch rotation too.
+            dirpath = os.path.dirname(os.path.abspath(path))
+            mask = _IN_MODIFY | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+            if libc.inotify_add_watch(inotify_fd, dirpath, mask) < 0:
+                os.close(inotify_fd)
+            else:
+                self.__inotify_fd = inotify_fd
+                self.__bot.add_reader(inotify_fd, self.__inotify_readable)
+
+        saved = self.__load_offset()
+        if saved is not None and saved[0] == self.__stat_inode():
+            self.__open(saved[1])
+        else:
+            # Ignore existing, historical, content. We care only about
+            # new events.
+            self.__open()
+        self.__check()
+
+        if self.__inotify_fd is None:
+            self.__schedule_poll()
+
+    def close(self):
+        if self.__inotify_fd is not None:
+            self.__bot.remove_reader(self.__inotify_fd)
+            os.close(self.__inotify_fd)
+            self.__inotify_fd = None
+        if self.__poll_timer is not None:
+            self.__poll_timer.cancel()
+            self.__poll_timer = None
+        self.__save_offset()
+        self.__close_file()
+
+    def __stat_inode(self):
+        try:
+            return os.stat(self.__path).st_ino
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def __load_offset(self):
+        if self.__offset_file is None:
+            return None
+        try:
+            with open(self.__offset_file) as f:
+                inode, offset = [int(v) for v in f.read().split()]
+        except (IOError, ValueError):
+            return None
+        return inode, offset
+
+    def __save_offset(self):
+        if self.__offset_file is None or self.__inode is None:
+            return
+        dirpath = os.path.dirname(self.__offset_file)
+        if dirpath and not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        tmp_path = "%s.tmp" % self.__offset_file
+        with open(tmp_path, "w") as f:
+            f.write("%d %d\n" % (self.__inode, self.__offset))
+        os.rename(tmp_path, self.__offset_file)
+        self.__offset_saved_time = time.time()
+
+    def __close_file(self):
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+            self.__inode = None
+
+    def __open(self, offset=None):
+        # Open the file and continue from `offset`, or from the end if
+        # None.
+        try:
+            fd = os.open(self.__path, os.O_RDONLY)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            # Wait until the file appears.
+            return
+        st = os.fstat(fd)
+        self.__fd = fd
+        self.__inode = st.st_ino
+        self.__partial = b""
+        if offset is None or offset > st.st_size:
+            offset = st.st_size
+        self.__offset = offset
+        os.lseek(fd, offset, os.SEEK_SET)
+
+    def __read(self):
+        # Return True if any data was read.
+        chunks = []
+        while True:
+            chunk = os.read(self.__fd, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        if not chunks:
+            return False
+
+        lines = (self.__partial + b"".join(chunks)).split(b"\n")
+        self.__partial = lines.pop()
+        for line in lines:
+            self.__offset += len(line) + 1
+            self.__callback(line)
+        return True
+
+    def __check(self):
+        # Return True if any data was read.
+        is_active = False
+
+        if self.__fd is not None:
+            is_active = self.__read()
+            inode = self.__stat_inode()
+            if inode != self.__inode:
+                # Rotated, the rest of the old file has been read
+                # above, continue from the beginning of the new one.
+                self.__close_file()
+                self.__open(0)
+            elif os.fstat(self.__fd).st_size < self.__offset + len(self.__partial):
+                # Truncated.
+                self.__offset = 0
+                self.__partial = b""
+                os.lseek(self.__fd, 0, os.SEEK_SET)
+        else:
+            self.__open(0)
+
+        if self.__fd is not None:
+            is_active = self.__read() or is_active
+
+        if time.time() - self.__offset_saved_time > Tailer.OFFSET_SAVE_INTERVAL:
+            self.__save_offset()
+
+        return is_active
+
+    def __inotify_readable(self):
+        try:
+            while os.read(self.__inotify_fd, 4096):
+                # Events are not interesting, just check the file.
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+        self.__check()
+
+    def __schedule_poll(self):
+        self.__poll_timer = self.__bot.call_later(self.__poll_interval,
+                                                  self.__poll)
+
+    def __poll(self):
+        if self.__check():
+            self.__poll_interval = self.__min_poll_interval
+        else:
+            # Back off while idle.
+            self.__poll_interval = min(self.__poll_interval * 2,
+                                       self.__max_poll_interval)
+        self.__schedule_poll()